@@ -15,8 +15,22 @@ import os
 import gc
 import json
 import math
+import hashlib
+import time
+import random
+import platform
+import tracemalloc
+import mmap
+import re
+import heapq
 import pickle
+import struct
+import itertools
 import subprocess
+import concurrent.futures
+import multiprocessing
+import types
+import threading
 import collections
 import unicodedata
 
@@ -66,22 +80,136 @@ We'll load the data for the task, which comprises of a parallel corpus of Indian
 # Download the training and validation datasets
 !wget -O data.train.csv "https://docs.google.com/spreadsheets/d/1JpK9nOuZ2ctMrjNL-C0ghUQ4TesTrMER1-dTD_torAA/gviz/tq?tqx=out:csv&sheet=data.train.csv"
 !wget -O data.valid.csv "https://docs.google.com/spreadsheets/d/1cKC0WpWpIQJkaqnFb7Ou7d0syFDsj6eEW7bM7GH3u2k/gviz/tq?tqx=out:csv&sheet=data.valid.csv"
-def read_dataframe(ds_type):
+# Version of the data preparation steps, part of the cache key so that changes to them invalidate caches.
+DATA_PREPARATION_VERSION = 1
+
+def is_valid_pair(name, translation):
+    """ Checks whether a (normalized) instance pair is usable: both sides non-empty, without control
+        or replacement characters, and with a translation in the Devanagari script.
+
+    Args:
+        name (str): Source name.
+        translation (str): Target translation.
+
+    Returns:
+        bool: True if the pair is valid.
+    """
+
+    for string in (name, translation):
+        if not string or '\ufffd' in string or any(unicodedata.category(char)[0] == 'C' for char in string):
+            return False
+    return any('\u0900' <= char <= '\u097F' for char in translation)
+
+def prepare_dataframe(df):
+    """ Prepares raw instance pairs for training: strips and NFC-normalizes strings,
+        drops invalid pairs (see `is_valid_pair`), and merges duplicate pairs, counting their occurrences.
+
+    Args:
+        df (pd.DataFrame): DataFrame with 'Name' and 'Translation' columns.
+
+    Returns:
+        pd.DataFrame: Unique pairs in order of first occurrence, with their number of occurrences in 'Count',
+            indexed from 0.
+    """
+
+    df = df[['Name', 'Translation']].dropna().astype(str)
+    # Applying to an empty frame loses its columns.
+    if len(df):
+        df = df.apply(lambda column: column.str.strip().map(lambda string: unicodedata.normalize('NFC', string)))
+        df = df[[ is_valid_pair(name, translation) for name, translation in zip(df['Name'], df['Translation']) ]]
+    return df.groupby(['Name', 'Translation'], sort=False).size().rename('Count').reset_index()
+
+def file_digest(file_path, chunksize=1 << 20):
+    """ Returns the SHA-256 digest of a file's contents, as a hexadecimal string. """
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as ifile:
+        while chunk := ifile.read(chunksize):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_dataframe(ds_type, cache_dir=None):
     """ Loads a dataframe based on the given partition type.
 
+        Data is prepared with `prepare_dataframe`, and the result is cached as a NumPy archive of string buffers,
+        named after a hash of the source file and the preparation version. Later runs load the cache instead of parsing the CSV file again.
+
     Args:
         ds_type (str): Dataset type: train (train) or validation (valid)
+        cache_dir (str, optional): Directory to keep cache files in. Defaults to a 'data-cache' directory
+            within DIRECTORY_NAME.
 
     Returns:
-        pd.DataFrame: Pandas Dataframe for the specified partition.
+        pd.DataFrame: Pandas Dataframe for the specified partition, with unique 'Name' and 'Translation' pairs
+            and their number of occurrences in 'Count'.
     """
 
-    df = pd.read_csv(f"data.{ds_type}.csv", header=0)
-    df = df[~df.isna()]
-    df['Name'] = df['Name'].astype(str)
-    df['Translation'] = df['Translation'].astype(str)
+    source_file = f"data.{ds_type}.csv"
+    cache_dir   = cache_dir or os.path.join(DIRECTORY_NAME, "data-cache")
+    cache_file  = os.path.join(cache_dir, f"{ds_type}-v{DATA_PREPARATION_VERSION}-{file_digest(source_file)}.npz")
+
+    if os.path.exists(cache_file):
+        with numpy.load(cache_file) as archive:
+            columns = { 'Count': archive['Count'] }
+            for column in ('Name', 'Translation'):
+                columns[column] = archive[column].tobytes().decode('utf-8').split('\n') if len(columns['Count']) else []
+        return pd.DataFrame(columns, columns=[ 'Name', 'Translation', 'Count' ])
+
+    df = prepare_dataframe(pd.read_csv(source_file, header=0))
+
+    # Valid strings hold no control characters, so each column is stored as one newline-separated buffer.
+    sections = { 'Count': df['Count'].to_numpy(dtype=numpy.int64) }
+    for column in ('Name', 'Translation'):
+        sections[column] = numpy.frombuffer('\n'.join(df[column]).encode('utf-8'), dtype=numpy.uint8)
+
+    # Written under a temporary name first, so that an interrupted run never leaves a partial cache behind.
+    os.makedirs(cache_dir, exist_ok=True)
+    partial_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+    numpy.savez(partial_file, **sections)
+    os.replace(partial_file, cache_file)
     return df
 
+def iter_string_chunks(source, column='Name', chunksize=65536):
+    """ Reads strings in bounded-size chunks, from a CSV file or any iterable of strings.
+
+    Args:
+        source (str|Iterable[str]): Path to a CSV file with a header row, or an iterable of strings.
+        column (str, optional): Column to read strings from, if reading a CSV file. Defaults to 'Name'.
+        chunksize (int, optional): Maximum number of strings per chunk. Defaults to 65536.
+
+    Yields:
+        list[str]: The next chunk of strings, with missing values dropped.
+    """
+
+    if isinstance(source, (str, os.PathLike)):
+        for chunk in pd.read_csv(source, header=0, usecols=[column], chunksize=chunksize):
+            yield chunk[column].dropna().astype(str).to_list()
+    else:
+        iterator = iter(source)
+        while chunk := list(itertools.islice(iterator, chunksize)):
+            yield chunk
+
+def iter_pair_chunks(source, chunksize=65536, columns=('Name', 'Translation')):
+    """ Reads rows of string columns in bounded-size chunks, from a CSV file or a JSON Lines file.
+
+    Args:
+        source (str): Path to a CSV file with a header row, or to a JSON Lines file (ending in .jsonl or .json).
+        chunksize (int, optional): Maximum number of rows per chunk. Defaults to 65536.
+        columns (tuple[str], optional): Columns to read. Defaults to ('Name', 'Translation').
+
+    Yields:
+        list[tuple[str, ...]]: The next chunk of rows, with rows missing any value dropped.
+    """
+
+    if str(source).endswith(('.jsonl', '.json')):
+        reader = pd.read_json(source, lines=True, chunksize=chunksize, dtype=False)
+    else:
+        reader = pd.read_csv(source, header=0, usecols=list(columns), chunksize=chunksize)
+
+    for chunk in reader:
+        chunk = chunk[list(columns)].dropna().astype(str)
+        yield list(chunk.itertuples(index=False, name=None))
+
 # Load the training and validation datasets
 train_data      = read_dataframe("train")
 validation_data = read_dataframe("valid")
@@ -116,6 +244,266 @@ def combine(items, pair_to_combine, newt):
             combined.append(items[i])
             i += 1
     return combined
+
+class PairIndex:
+    """ Incremental index over adjacent token pairs, used for BPE training.
+        Keeps the count of every adjacent pair along with the positions it occurs at,
+        and updates both in place as merges are applied, so that a merge only touches
+        the occurrences of the merged pair instead of the whole corpus. """
+
+    def __init__(self, words, weights=None, offset=0):
+        """ Initializes the index over the given token sequences.
+
+        Args:
+            words (list[list[int]]): Token sequences to index. Pairs are never counted across sequences.
+            weights (list[int], optional): Number of times each sequence occurs. Defaults to 1 per sequence.
+            offset (int, optional): Position of the first token, for ordering occurrences across indices. Defaults to 0.
+        """
+
+        self.ids, self.next, self.prev, self.weight = [], [], [], []
+        self.offset = offset
+        self.counts = {}
+        self.where = {}
+        self.first = {}
+        self.changed = set()
+
+        if weights is None:
+            weights = [ 1 ] * len(words)
+        for word, weight in zip(words, weights):
+            start = len(self.ids)
+            self.ids.extend(word)
+            self.prev.extend(range(start - 1, start + len(word) - 1))
+            self.next.extend(range(start + 1, start + len(word) + 1))
+            self.weight.extend([ weight ] * len(word))
+            if word:
+                self.prev[start] = -1
+                self.next[-1] = -1
+
+        for position, following in enumerate(self.next):
+            if following != -1:
+                self._add((self.ids[position], self.ids[following]), position)
+        self.changed = set()
+
+    def _add(self, pair, position):
+        """ Records an occurrence of a pair starting at the given position. """
+        self.counts[pair] = self.counts.get(pair, 0) + self.weight[position]
+        self.where.setdefault(pair, set()).add(position)
+        if position < self.first.get(pair, position + 1):
+            self.first[pair] = position
+        self.changed.add(pair)
+
+    def _remove(self, pair, position):
+        """ Forgets an occurrence of a pair starting at the given position.
+            The first position of the pair is left as is, and remains a lower bound. """
+        occurrences = self.where[pair]
+        occurrences.discard(position)
+        self.counts[pair] -= self.weight[position]
+        if not occurrences:
+            del self.counts[pair], self.where[pair], self.first[pair]
+        self.changed.add(pair)
+
+    def first_bound(self, pair):
+        """ Returns a lower bound on the position of the leftmost occurrence of a pair, across indices. """
+        return self.offset + self.first[pair]
+
+    def first_position(self, pair):
+        """ Returns the position of the leftmost occurrence of a pair, across indices. """
+        self.first[pair] = min(self.where[pair])
+        return self.offset + self.first[pair]
+
+    def merge(self, pair, idx):
+        """ Replaces every occurrence of a pair with a new token, left to right.
+
+        Args:
+            pair (tuple[int, int]): Pair of tokens to merge.
+            idx (int): Token id to assign to the merged pair.
+
+        Returns:
+            set[tuple[int, int]]: Pairs whose counts or positions changed due to the merge.
+        """
+
+        ids, nxt, prv = self.ids, self.next, self.prev
+        self.changed = set()
+
+        for position in sorted(self.where.get(pair, ())):
+            following = nxt[position]
+            # Overlapping occurrences (such as in 'aaa') may already be consumed by an earlier merge.
+            if ids[position] != pair[0] or following == -1 or ids[following] != pair[1]:
+                continue
+
+            before, after = prv[position], nxt[following]
+            if before != -1:
+                self._remove((ids[before], ids[position]), before)
+            if after != -1:
+                self._remove((ids[following], ids[after]), following)
+            self._remove(pair, position)
+
+            ids[position], ids[following] = idx, -1
+            nxt[position] = after
+            if after != -1:
+                prv[after] = position
+
+            if before != -1:
+                self._add((ids[before], idx), before)
+            if after != -1:
+                self._add((idx, ids[after]), position)
+
+        changed, self.changed = self.changed, set()
+        return changed
+
+def _pair_index_worker(connection, words, weights, offset):
+    """ Maintains a PairIndex over one shard of a corpus, serving requests received over a connection.
+        Replies to a merge with the count and first position bound of every changed pair (None if it vanished),
+        and to a position query with the exact first position of the pair. """
+
+    index = PairIndex(words, weights, offset)
+    connection.send({ pair: (count, index.first_bound(pair)) for pair, count in index.counts.items() })
+
+    while (message := connection.recv()) is not None:
+        if message[0] == 'first':
+            connection.send(index.first_position(message[1]))
+            continue
+        changed = index.merge(*message[1:])
+        connection.send({
+            pair: (index.counts[pair], index.first_bound(pair)) if pair in index.counts else None
+            for pair in changed
+        })
+    connection.close()
+
+class ShardedPairIndex:
+    """ Pair index over a corpus split into shards, each indexed and merged by a separate worker process.
+        Counts are reduced centrally, and the index can be used in place of a PairIndex with learn_merges. """
+
+    def __init__(self, words, weights, num_workers):
+        """ Initializes the index, starting one worker process per shard.
+
+        Args:
+            words (list[list[int]]): Token sequences to index. Pairs are never counted across sequences.
+            weights (list[int]): Number of times each sequence occurs.
+            num_workers (int): Number of shards (and worker processes) to split the corpus into.
+        """
+
+        context    = multiprocessing.get_context()
+        shard_size = max(1, math.ceil(len(words) / num_workers))
+
+        self.connections, self.workers = [], []
+        offset = 0
+        for start in range(0, len(words), shard_size):
+            shard = words[start:start+shard_size]
+            parent_end, child_end = context.Pipe()
+            worker = context.Process(
+                target=_pair_index_worker, daemon=True,
+                args=(child_end, shard, weights[start:start+shard_size], offset)
+            )
+            worker.start()
+            child_end.close()
+            self.connections.append(parent_end)
+            self.workers.append(worker)
+            offset += sum(map(len, shard))
+
+        # Per pair, the count and first position bound of the pair within every shard it occurs in.
+        self.shards = collections.defaultdict(dict)
+        self.counts = {}
+        for shard, connection in enumerate(self.connections):
+            for pair, stats in connection.recv().items():
+                self.shards[pair][shard] = stats
+        for pair in self.shards:
+            self._reduce(pair)
+
+    def _reduce(self, pair):
+        """ Recomputes the total count of a pair from the per-shard counts. """
+        if self.shards.get(pair):
+            self.counts[pair] = sum(count for count, _ in self.shards[pair].values())
+        else:
+            self.counts.pop(pair, None)
+            self.shards.pop(pair, None)
+
+    def first_bound(self, pair):
+        """ Returns a lower bound on the position of the leftmost occurrence of a pair, across shards. """
+        return min(position for _, position in self.shards[pair].values())
+
+    def first_position(self, pair):
+        """ Returns the position of the leftmost occurrence of a pair, across shards. """
+        stats = self.shards[pair]
+        for shard in stats:
+            self.connections[shard].send(('first', pair))
+        for shard, (count, _) in stats.items():
+            stats[shard] = (count, self.connections[shard].recv())
+        return self.first_bound(pair)
+
+    def merge(self, pair, idx):
+        """ Replaces every occurrence of a pair with a new token, in all shards in parallel.
+
+        Args:
+            pair (tuple[int, int]): Pair of tokens to merge.
+            idx (int): Token id to assign to the merged pair.
+
+        Returns:
+            set[tuple[int, int]]: Pairs whose counts or positions changed due to the merge.
+        """
+
+        for connection in self.connections:
+            connection.send(('merge', pair, idx))
+
+        changed = set()
+        for shard, connection in enumerate(self.connections):
+            for changed_pair, stats in connection.recv().items():
+                if stats is None:
+                    self.shards[changed_pair].pop(shard, None)
+                else:
+                    self.shards[changed_pair][shard] = stats
+                changed.add(changed_pair)
+
+        for changed_pair in changed:
+            self._reduce(changed_pair)
+        return changed
+
+    def close(self):
+        """ Stops the worker processes. """
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+
+def learn_merges(index, num_merges, first_id=256):
+    """ Learns BPE merge rules over an indexed corpus.
+        The most frequent pair is merged at every step, with ties going to the pair that occurs first,
+        which matches repeatedly taking `max` over the pair counts of the merged corpus.
+
+    Args:
+        index (PairIndex|ShardedPairIndex): Index over the corpus to learn merges from. Updated in place.
+        num_merges (int): Number of merges to learn.
+        first_id (int, optional): Token id to assign to the first merge. Defaults to 256.
+
+    Returns:
+        dict[tuple[int, int], int]: Learnt merge rules, mapping pairs to merged token ids, in order of learning.
+    """
+
+    heap = [ (-count, index.first_bound(pair), pair) for pair, count in index.counts.items() ]
+    heapq.heapify(heap)
+
+    merges = {}
+    for idx in range(first_id, first_id + num_merges):
+        # Entries are pushed again on every change, so outdated ones can simply be skipped.
+        # Positions are lower bounds, which are only made exact for the best candidate.
+        while heap:
+            count, position, pair = heapq.heappop(heap)
+            if index.counts.get(pair) != -count:
+                continue
+            if (first := index.first_position(pair)) == position:
+                break
+            heapq.heappush(heap, (count, first, pair))
+        else:
+            break
+
+        merges[pair] = idx
+        for changed in index.merge(pair, idx):
+            if changed in index.counts:
+                heapq.heappush(heap, (-index.counts[changed], index.first_bound(changed), changed))
+
+    return merges
+
 mergerules = {}
 namecol = train_data["Name"].to_list()
 transcol = train_data["Translation"].to_list()
@@ -131,13 +519,7 @@ text = [item for sublist in names for item in sublist]
 tokens = [item for sublist in iter2 for item in sublist]
 vocab_size = 290
 merge_count = vocab_size - 256
-ids = list(tokens)
-for i in range(merge_count):
-    pair_stats = count_pairs(ids)
-    top_pair = max(pair_stats, key=pair_stats.get)
-    new_id = 256 + i
-    ids = combine(ids, top_pair, new_id)
-    mergerules[top_pair] = new_id
+mergerules = learn_merges(PairIndex([ tokens ]), merge_count)
 def encode(text):
   tokens = list(text.encode("utf-8"))
   while len(tokens) >= 2:
@@ -178,11 +560,167 @@ special_token = '\x04'
 encoded_special = encode(special_token)
 subset_example = tokens[:3]
 # END CODE
+
+SECTIONED_FILE_ALIGNMENT = 64
+
+def write_sectioned_file(file_path, magic, version, config, sections):
+    """ Writes a binary file made of a JSON header followed by raw, aligned array sections.
+
+        Layout: magic bytes, version and header length (little-endian uint32s), the JSON header
+            (holding the config and the offset, dtype and shape of every section), then the sections.
+
+    Args:
+        file_path (str): Path of the file to write.
+        magic (bytes): Magic bytes identifying the file type.
+        version (int): Version of the file format.
+        config (dict[str, any]): JSON-serializable configuration to store in the header.
+        sections (dict[str, numpy.ndarray]): Named arrays to store.
+    """
+
+    sections = { name: numpy.ascontiguousarray(array) for name, array in sections.items() }
+
+    # Offsets depend on the header length, which in turn depends on the offsets, so iterate to a fixed point.
+    header_size = 0
+    while True:
+        offset, layout = len(magic) + 8 + header_size, {}
+        for name, array in sections.items():
+            offset = -(-offset // SECTIONED_FILE_ALIGNMENT) * SECTIONED_FILE_ALIGNMENT
+            layout[name] = { 'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape) }
+            offset += array.nbytes
+        header = json.dumps({ 'config': config, 'sections': layout }).encode('utf-8')
+        if len(header) == header_size:
+            break
+        header_size = len(header)
+
+    # Written aside and then swapped in, so that memory-mapped readers of an existing file, which may be
+    # the source of the arrays being written, keep seeing the old contents.
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'wb') as ofile:
+        ofile.write(magic + struct.pack('<II', version, len(header)) + header)
+        for name, array in sections.items():
+            ofile.write(b'\0' * (layout[name]['offset'] - ofile.tell()))
+            ofile.write(array.tobytes())
+    os.replace(temp_path, file_path)
+
+def read_sectioned_file(file_path, magic, max_version):
+    """ Memory-maps a file written by `write_sectioned_file`.
+        Sections are returned as read-only arrays backed by the mapping, so processes share one physical copy.
+
+    Args:
+        file_path (str): Path of the file to read.
+        magic (bytes): Expected magic bytes.
+        max_version (int): Latest supported version of the file format.
+
+    Raises:
+        ValueError: If the file is not of the expected type, or of an unsupported version.
+
+    Returns:
+        tuple[int, dict[str, any], dict[str, numpy.ndarray]]: Version, configuration and named sections.
+    """
+
+    with open(file_path, 'rb') as ifile:
+        mapping = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mapping[:len(magic)] != magic:
+        raise ValueError(read_sectioned_file.__name__ + f": {file_path} is not a valid file of this type")
+    version, header_size = struct.unpack_from('<II', mapping, len(magic))
+    if version > max_version:
+        raise ValueError(read_sectioned_file.__name__ + f": unsupported format version {version} in {file_path}")
+
+    header_start = len(magic) + 8
+    header = json.loads(bytes(mapping[header_start:header_start+header_size]).decode('utf-8'))
+    sections = {
+        name: numpy.frombuffer(
+            mapping, dtype=numpy.dtype(spec['dtype']),
+            count=math.prod(spec['shape']), offset=spec['offset']
+        ).reshape(spec['shape'])
+        for name, spec in header['sections'].items()
+    }
+    return version, header['config'], sections
+
+# Tokenizer used by the current worker process of a pool, set once when the worker starts.
+_worker_tokenizer = None
+
+def _init_encode_worker(tokenizer):
+    """ Stores the tokenizer for a worker process, so that it is transferred once rather than per task. """
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+def _encode_chunk(chunk, add_start, add_end, tokenizer=None):
+    """ Encodes a chunk of strings into a flat token buffer and per-string lengths. """
+    tokenizer = tokenizer or _worker_tokenizer
+    encoded = [ tokenizer.encode(string, add_start, add_end) for string in chunk ]
+    lengths = numpy.fromiter(map(len, encoded), dtype=numpy.int64, count=len(encoded))
+    tokens  = numpy.fromiter(itertools.chain.from_iterable(encoded), dtype=numpy.int32, count=int(lengths.sum()))
+    return tokens, lengths
+
+def pad_token_slices(tokens, offsets, rows, padding, pad_id):
+    """ Gathers rows of a flat token buffer into a padded array, following the same layout as `Tokenizer.pad`:
+        all tokens but the last at the start of the row, and the last token in the final position.
+
+    Args:
+        tokens (numpy.ndarray): Flat buffer of tokens, as returned by `Tokenizer.encode_corpus`.
+        offsets (numpy.ndarray): Offsets of every row in the buffer, with a final end offset.
+        rows (list[int]|numpy.ndarray): Indices of the rows to gather.
+        padding (int, optional): Length to pad to. Defaults to the longest gathered row, if None.
+        pad_id (int): Id of the padding token.
+
+    Raises:
+        ValueError: If a row does not fit in the padding length.
+
+    Returns:
+        tuple[numpy.ndarray, numpy.ndarray]: Padded token ids (int64) of shape [len(rows), length], and row lengths.
+    """
+
+    rows    = numpy.asarray(rows, dtype=numpy.int64)
+    starts  = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    width   = padding or int(lengths.max(initial=0))
+    if (lengths > width).any():
+        raise ValueError(pad_token_slices.__name__ + f": rows of up to {int(lengths.max())} tokens do not fit in {width}")
+
+    token_ids = numpy.full((len(rows), width), pad_id, dtype=numpy.int64)
+    columns   = numpy.arange(width)[None, :]
+    body      = columns < (lengths - 1)[:, None]
+    token_ids[body] = tokens[(starts[:, None] + columns)[body]]
+    if width:
+        filled = lengths > 0
+        token_ids[filled, width-1] = tokens[starts[filled] + lengths[filled] - 1]
+    return token_ids, lengths
+
+# Devanagari consonant (with an optional nukta), vowel signs (matras) and modifiers (anusvara, visarga, etc.).
+_DEVANAGARI_CONSONANT = r'[\u0915-\u0939\u0958-\u095F\u0978-\u097F]\u093C?'
+_DEVANAGARI_MATRA     = r'[\u093A\u093B\u093E-\u094C\u094E\u094F\u0955-\u0957\u0962\u0963]'
+_DEVANAGARI_MODIFIER  = r'[\u0900-\u0903]'
+
+AKSHARA_PATTERN = re.compile(
+    # Consonant cluster joined by viramas, ending in a virama (half form) or matras, then modifiers.
+    rf'{_DEVANAGARI_CONSONANT}(?:\u094D[\u200C\u200D]?{_DEVANAGARI_CONSONANT})*'
+    rf'(?:\u094D[\u200C\u200D]?|{_DEVANAGARI_MATRA}*){_DEVANAGARI_MODIFIER}*'
+    # Independent vowel, then modifiers.
+    rf'|[\u0904-\u0914\u0960\u0961\u0972-\u0977]{_DEVANAGARI_MODIFIER}*'
+    # Anything else is a unit of its own.
+    r'|.',
+    re.DOTALL
+)
+
+def split_aksharas(string):
+    """ Segments a string into aksharas (Devanagari syllables: consonant clusters with their matras and modifiers).
+        Characters outside of Devanagari are segmented individually.
+
+    Args:
+        string (str): String to segment.
+
+    Returns:
+        list[str]: Aksharas of the string, in order.
+    """
+    return AKSHARA_PATTERN.findall(string)
+
 class Tokenizer:
     """ Represents the tokenizer for text data.
         Provides methods to encode and decode strings (as instance or as a batch). """
 
-    def __init__(self,data):
+    def __init__(self,data,cache_size=0,pretokenize=None):
         """ Initializes a new tokenizer.
 
             Any variables required in intermediate operations are declared here.
@@ -190,6 +728,14 @@ class Tokenizer:
 
             All variables declared in this function will be serialized
                 and deserialized when loading and saving the Tokenizer.
+
+        Args:
+            data (list[str]): Corpus the tokenizer is meant for. Unused, training data is passed to `train`.
+            cache_size (int, optional): Maximum number of entries in each of the LRU caches
+                for `encode` and `decode`. Caching is disabled when 0. Defaults to 0.
+            pretokenize (str, optional): If 'akshara', strings are first segmented into aksharas
+                (see `split_aksharas`), and frequent aksharas become initial tokens of their own,
+                before any merges are learnt. Meant for Devanagari text. Defaults to None (bytes only).
             """
 
         # BEGIN CODE : tokenizer.init
@@ -197,42 +743,261 @@ class Tokenizer:
         # ADD YOUR CODE HERE
         self.vocab ={}
         self.merges = {}
-        self.get_vocab={}
         self.SOT_token = b'\x01'
         self.EOT_token = b'\x04'
         self.pad_token = b'\x00'
-        self.add_start = False
-        self.add_end =False
-        self.strip_special = False
+        self.pretokenize = pretokenize
+        self.units = {}
+        self.word_counts = collections.Counter()
+        self._word_counts_file = None
+        self.cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self.build_lookup_tables()
+        self.clear_cache()
 
         # END CODE
 
+    def __getstate__(self):
+        """ Returns the state to serialize. Cache contents and statistics are left out, only the cache size is kept.
+            Lookup tables are left out as well, and rebuilt on deserialization.
+            So are the training statistics, which only `extend` needs: they are reloaded from the saved file, if any. """
+        state = self.__dict__.copy()
+        for transient in ('_caches', '_cache_stats', '_cache_lock', '_token_ids', '_special_token_ids',
+                          '_vocab_bytes', '_vocab_offsets', 'get_vocab'):
+            state.pop(transient, None)
+        state['word_counts'] = None
+        return state
+
+    def __setstate__(self, state):
+        """ Restores a serialized state, with empty caches. """
+        self.__dict__.update(state)
+        self.__dict__.setdefault('cache_size', 0)
+        self.__dict__.setdefault('pretokenize', None)
+        self.__dict__.setdefault('units', {})
+        self.__dict__.setdefault('word_counts', collections.Counter())
+        self.__dict__.setdefault('_word_counts_file', None)
+        # Fields of legacy pickles that are now derived, or passed as arguments instead.
+        for legacy in ('get_vocab', 'add_start', 'add_end', 'strip_special'):
+            self.__dict__.pop(legacy, None)
+        self._cache_lock = threading.Lock()
+        self.build_lookup_tables()
+        self.clear_cache()
+
+    def build_lookup_tables(self):
+        """ Builds the inverse vocabulary and the special token ids, once per vocabulary.
+            Both are exposed as read-only mappings, through `token_ids` and `special_token_ids`.
+            Also lays out the bytes of all tokens in one flat table, indexed by per-id offsets, for `batch_decode`. """
+
+        token_ids = { token: idx for idx, token in self.vocab.items() }
+        self._token_ids = types.MappingProxyType(token_ids)
+        self._special_token_ids = types.MappingProxyType({
+            token: token_ids[token] for token in (self.SOT_token, self.EOT_token) if token in token_ids
+        })
+
+        num_ids = max(self.vocab, default=-1) + 1
+        self._vocab_bytes = numpy.frombuffer(
+            b"".join(self.vocab.get(idx, b"") for idx in range(num_ids)), dtype=numpy.uint8
+        )
+        self._vocab_offsets = numpy.zeros(num_ids + 1, dtype=numpy.int64)
+        for idx, token in self.vocab.items():
+            self._vocab_offsets[idx + 1] = len(token)
+        numpy.cumsum(self._vocab_offsets, out=self._vocab_offsets)
+
+    @property
+    def token_ids(self):
+        """ Read-only mapping of tokens (bytes) to token ids. """
+        return self._token_ids
+
+    @property
+    def special_token_ids(self):
+        """ Read-only mapping of the start and end of sequence tokens (bytes) to token ids. """
+        return self._special_token_ids
+
+    @property
+    def pad_token_id(self):
+        """ Token id of the padding token. """
+        return self._token_ids[self.pad_token]
+
+    def clear_cache(self):
+        """ Empties the encode and decode caches and resets their statistics. """
+        with self._cache_lock:
+            self._caches      = { 'encode': collections.OrderedDict(), 'decode': collections.OrderedDict() }
+            self._cache_stats = { name: { 'hits': 0, 'misses': 0, 'evictions': 0 } for name in self._caches }
+
+    def cache_info(self):
+        """ Returns statistics about the encode and decode caches.
+
+        Returns:
+            dict[str, dict[str, int]]: Hits, misses, evictions and current size per cache, along with the maximum size.
+        """
+        return {
+            name: { **self._cache_stats[name], 'size': len(cache), 'max_size': self.cache_size }
+            for name, cache in self._caches.items()
+        }
+
+    def _cache_lookup(self, name, key):
+        """ Returns a cached value (marking it as most recently used), or None on a miss. """
+        with self._cache_lock:
+            cache = self._caches[name]
+            if key in cache:
+                cache.move_to_end(key)
+                self._cache_stats[name]['hits'] += 1
+                return cache[key]
+            self._cache_stats[name]['misses'] += 1
+            return None
+
+    def _cache_store(self, name, key, value):
+        """ Caches a value, evicting the least recently used entry if the cache is full. """
+        with self._cache_lock:
+            cache = self._caches[name]
+            cache[key] = value
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+                self._cache_stats[name]['evictions'] += 1
+
+    FILE_MAGIC   = b'BPETOKN\0'
+    FILE_VERSION = 1
+
+    # Limits on pre-tokenized units, so that most of the vocabulary is left to merges.
+    MAX_UNIT_SHARE = 0.25
+    MIN_UNIT_COUNT = 2
+
     @classmethod
     def load(cls, path):
         """ Loads a pre-trained tokenizer from the given directory.
-           This directory will have a tokenizer.pkl file that contains all the tokenizer variables.
+           This directory will have a tokenizer.bin file that contains all the tokenizer variables,
+           or a legacy tokenizer.pkl file for tokenizers saved before the binary format.
+
+           The binary file is memory-mapped: the merges and the vocabulary bytes are read from the
+           mapping, which all processes loading the same file share.
 
         Args:
             path (str): Path to load the tokenizer from.
         """
-        tokenizer_file = os.path.join(path, "tokenizer.pkl")
+        tokenizer_file = os.path.join(path, "tokenizer.bin")
+        legacy_file    = os.path.join(path, "tokenizer.pkl")
+
+        if os.path.exists(tokenizer_file):
+            return cls._load_binary(tokenizer_file)
 
-        if not os.path.exists(path) or not os.path.exists(os.path.join(path, "tokenizer.pkl")):
+        if not os.path.exists(path) or not os.path.exists(legacy_file):
             raise ValueError(cls.load.__name__ + ": No tokenizer found at the specified directory")
 
-        with open(tokenizer_file, "rb") as ifile:
+        with open(legacy_file, "rb") as ifile:
             return pickle.load(ifile)
 
+    @classmethod
+    def _load_binary(cls, tokenizer_file):
+        """ Loads a tokenizer from a memory-mapped tokenizer.bin file. """
+
+        _, config, sections = read_sectioned_file(tokenizer_file, cls.FILE_MAGIC, cls.FILE_VERSION)
+
+        offsets, data = sections['vocab_offsets'], sections['vocab_bytes']
+        bounds = offsets.tolist()
+        state = {
+            'vocab': {
+                idx: bytes(data[start:end])
+                for idx, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])) if end > start
+            },
+            'merges': { (p0, p1): idx for p0, p1, idx in sections['merges'].tolist() },
+            'SOT_token': bytes(config['SOT_token']),
+            'EOT_token': bytes(config['EOT_token']),
+            'pad_token': bytes(config['pad_token']),
+            'cache_size': config['cache_size'],
+            'pretokenize': config.get('pretokenize'),
+        }
+        state['units'] = { state['vocab'][idx]: idx for idx in config.get('units', []) }
+        # Training statistics are only read by `extend`, on first use.
+        stats_file = os.path.join(os.path.dirname(tokenizer_file), "tokenizer.stats.bin")
+        state['word_counts'] = None
+        state['_word_counts_file'] = stats_file if os.path.exists(stats_file) else None
+
+        tokenizer = cls.__new__(cls)
+        tokenizer.__setstate__(state)
+        # Decode straight from the shared mapping, rather than a private copy of the byte table.
+        tokenizer._vocab_offsets, tokenizer._vocab_bytes = offsets, data
+        return tokenizer
+
     def save(self, path):
-        """ Saves a trained tokenizer to a given directory, inside a tokenizer.pkl file.
+        """ Saves a trained tokenizer to a given directory, inside a tokenizer.bin file.
+
+            The file holds a versioned header with the configuration, followed by the merges
+            as packed integer arrays and the vocabulary bytes as one contiguous blob.
+            The training statistics (unique strings and their counts), which only `extend` needs,
+            are kept separately in a tokenizer.stats.bin file of the same format, so that loading stays cheap.
 
         Args:
             path (str): Directory to save the tokenizer in.
         """
 
         os.makedirs(path, exist_ok=True)
-        with open(os.path.join(path, "tokenizer.pkl"), 'wb') as ofile:
-            pickle.dump(self, ofile)
+        # Read before any file is overwritten, in case the statistics are still in the saved files.
+        word_counts = self.training_counts()
+
+        config = {
+            'SOT_token': list(self.SOT_token),
+            'EOT_token': list(self.EOT_token),
+            'pad_token': list(self.pad_token),
+            'cache_size': self.cache_size,
+            'pretokenize': self.pretokenize,
+            'units': sorted(self.units.values()),
+        }
+        sections = {
+            'merges': numpy.array([ (p0, p1, idx) for (p0, p1), idx in self.merges.items() ], dtype=numpy.int32).reshape(-1, 3),
+            'vocab_offsets': self._vocab_offsets,
+            'vocab_bytes': self._vocab_bytes,
+        }
+
+        write_sectioned_file(os.path.join(path, "tokenizer.bin"), self.FILE_MAGIC, self.FILE_VERSION, config, sections)
+
+        stats_file = os.path.join(path, "tokenizer.stats.bin")
+        if word_counts:
+            words = [ word.encode('utf-8') for word in word_counts ]
+            write_sectioned_file(stats_file, self.FILE_MAGIC, self.FILE_VERSION, {}, {
+                'word_bytes': numpy.frombuffer(b"".join(words), dtype=numpy.uint8),
+                'word_offsets': numpy.cumsum([ 0 ] + [ len(word) for word in words ], dtype=numpy.int64),
+                'word_counts': numpy.array(list(word_counts.values()), dtype=numpy.int64),
+            })
+        elif os.path.exists(stats_file):
+            os.remove(stats_file)
+
+    def training_counts(self):
+        """ Returns the table of unique strings seen in training and their counts, used by `extend`.
+            For loaded tokenizers, the table is read from the saved statistics on first use.
+
+        Returns:
+            collections.Counter: Mapping of unique strings to their number of occurrences.
+                Empty if the statistics are unavailable, e.g., for legacy tokenizers.
+        """
+
+        if self.word_counts is None:
+            self.word_counts = collections.Counter()
+            if self._word_counts_file is not None:
+                _, _, sections = read_sectioned_file(self._word_counts_file, self.FILE_MAGIC, self.FILE_VERSION)
+                word_data, word_bounds = sections['word_bytes'], sections['word_offsets'].tolist()
+                self.word_counts.update({
+                    bytes(word_data[start:end]).decode('utf-8'): count
+                    for start, end, count in zip(word_bounds[:-1], word_bounds[1:], sections['word_counts'].tolist())
+                })
+            self._word_counts_file = None
+        return self.word_counts
+
+    def fingerprint(self):
+        """ Returns a hash identifying the tokenizer, i.e., everything that determines its outputs.
+            Tokenizers with the same fingerprint encode and decode strings identically.
+
+        Returns:
+            str: Hexadecimal SHA-256 digest.
+        """
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps([
+            list(self.SOT_token), list(self.EOT_token), list(self.pad_token), self.pretokenize, sorted(self.units.values())
+        ]).encode('utf-8'))
+        digest.update(numpy.array([ (p0, p1, idx) for (p0, p1), idx in self.merges.items() ], dtype=numpy.int64).tobytes())
+        digest.update(self._vocab_offsets.tobytes())
+        digest.update(self._vocab_bytes.tobytes())
+        return digest.hexdigest()
 
     def get_stats(self,ids):
         counts = {}
@@ -252,7 +1017,56 @@ class Tokenizer:
                 i += 1
         return newids
 
-    def train(self, data, vocab_size):
+    def apply_merges(self, tokens):
+        """ Applies the learnt merge rules to a sequence of tokens, lowest ranked (earliest learnt) merge first.
+            Tokens are kept in a linked list and candidate pairs in a heap ordered by rank and position,
+            so each merge is applied in place in O(log n), and the output matches repeatedly merging
+            every occurrence of the lowest ranked pair.
+
+        Args:
+            tokens (list[int]|bytes): Initial tokens, such as the UTF-8 bytes of a string.
+
+        Returns:
+            list[int]: Tokens after applying all possible merges.
+        """
+
+        merges = self.merges
+        tokens = list(tokens)
+        size   = len(tokens)
+        if size < 2:
+            return tokens
+
+        nxt = list(range(1, size + 1))
+        prv = list(range(-1, size - 1))
+        nxt[-1] = -1
+
+        heap = []
+        for position in range(size - 1):
+            rank = merges.get((tokens[position], tokens[position + 1]))
+            if rank is not None:
+                heap.append((rank, position))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, position = heapq.heappop(heap)
+            following = nxt[position]
+            # Candidates may be outdated by merges applied after they were pushed.
+            if tokens[position] == -1 or following == -1 or merges.get((tokens[position], tokens[following])) != rank:
+                continue
+
+            tokens[position], tokens[following] = rank, -1
+            after = nxt[position] = nxt[following]
+            if after != -1:
+                prv[after] = position
+                if (next_rank := merges.get((rank, tokens[after]))) is not None:
+                    heapq.heappush(heap, (next_rank, position))
+            before = prv[position]
+            if before != -1 and (next_rank := merges.get((tokens[before], rank))) is not None:
+                heapq.heappush(heap, (next_rank, before))
+
+        return [ token for token in tokens if token != -1 ]
+
+    def train(self, data, vocab_size, unique_words=False, num_workers=None):
         """ Trains a tokenizer to learn meaningful representations from input data.
             In the end, learns a vocabulary of a fixed size over the given data.
             Special tokens, if any, must not be counted towards this vocabulary.
@@ -260,31 +1074,189 @@ class Tokenizer:
         Args:
             data (list[str]): List of input strings from a text corpus.
             vocab_size (int): Final desired size of the vocab to be learnt.
+            unique_words (bool, optional): If true, learns merges over the unique strings weighted by
+                their frequency, instead of the concatenated corpus. Merges then never span two strings.
+                Defaults to False.
+            num_workers (int, optional): If more than one, splits the unique strings into as many shards
+                and counts and merges pairs in a pool of worker processes. Produces the same merges as
+                training in a single process. Requires `unique_words`. Defaults to None.
+
+        Raises:
+            ValueError: If multiple workers are requested without `unique_words`.
         """
 
         # BEGIN CODE : tokenizer.train
         # ADD YOUR CODE HERE
+        if unique_words:
+            self.train_counts(collections.Counter(data), vocab_size, num_workers)
+            return
+        if num_workers is not None and num_workers > 1:
+            raise ValueError(self.train.__name__ + ": sharded training requires unique_words")
+
+        self.word_counts = collections.Counter(data)
+        self._word_counts_file = None
+        self.learn_units(self.word_counts, vocab_size)
+
         names = data
         i=[]
         for name in names:
-            i.append(list(name.encode('utf-8')))
+            i.append(self.initial_tokens(name))
         text = [item for sublist in names for item in sublist]
         tokens = [item for sublist in i for item in sublist]
 
         vocab_size = vocab_size
-        num_merges = vocab_size - 256
-        ids = list(tokens)
-        for i in range(num_merges):
-            stats = self.get_stats(ids)
-            pair = max(stats, key=stats.get)
-            idx = 256 + i
-            ids = self.merge(ids, pair, idx)
-            self.merges[pair] = idx
+        num_merges = vocab_size - 256 - len(self.units)
+        self.merges = learn_merges(PairIndex([ tokens ]), num_merges, 256 + len(self.units))
+        self.build_vocab()
+        # END CODE
+
+    def train_counts(self, word_counts, vocab_size, num_workers=None):
+        """ Trains the tokenizer over a table of unique strings and their frequencies.
+            Each string is processed once per merge regardless of how often it occurs.
+
+        Args:
+            word_counts (dict[str, int]): Mapping of unique strings to their number of occurrences.
+            vocab_size (int): Final desired size of the vocab to be learnt.
+            num_workers (int, optional): If more than one, number of worker processes to shard the table across.
+                Defaults to None.
+        """
+
+        self.word_counts = collections.Counter(word_counts)
+        self._word_counts_file = None
+        self.learn_units(word_counts, vocab_size)
+
+        words      = [ self.initial_tokens(word) for word in word_counts ]
+        weights    = list(word_counts.values())
+        first_id   = 256 + len(self.units)
+        num_merges = vocab_size - first_id
+
+        if num_workers is not None and num_workers > 1:
+            index = ShardedPairIndex(words, weights, num_workers)
+            try:
+                self.merges = learn_merges(index, num_merges, first_id)
+            finally:
+                index.close()
+        else:
+            self.merges = learn_merges(PairIndex(words, weights), num_merges, first_id)
+        self.build_vocab()
+
+    def train_from_stream(self, source, vocab_size, column='Name', chunksize=65536, num_workers=None):
+        """ Trains the tokenizer from a CSV file or an iterable of strings, read in bounded-size chunks.
+            Only the table of unique strings and their counts is held in memory, never the corpus itself.
+
+        Args:
+            source (str|Iterable[str]): Path to a CSV file with a header row, or an iterable of input strings.
+            vocab_size (int): Final desired size of the vocab to be learnt.
+            column (str, optional): Column to read strings from, if reading a CSV file. Defaults to 'Name'.
+            chunksize (int, optional): Number of strings to read at a time. Defaults to 65536.
+            num_workers (int, optional): Number of worker processes to train with, as in `train_counts`. Defaults to None.
+        """
+
+        word_counts = collections.Counter()
+        for chunk in iter_string_chunks(source, column, chunksize):
+            word_counts.update(chunk)
+        self.train_counts(word_counts, vocab_size, num_workers)
+
+    def extend(self, data, vocab_size, num_workers=None):
+        """ Extends a trained tokenizer with new data, up to a larger vocabulary.
+            All existing merges, units and ids are kept as is, and new merges get the ids after them,
+            so models trained with the old vocabulary remain valid (see `enlarge_vocabulary`).
+
+            New merges are learnt over the strings seen in training so far and the new strings,
+            weighted by frequency, each pre-encoded with the existing merges. Merges never span two strings.
+
+        Args:
+            data (list[str]): List of new input strings.
+            vocab_size (int): Final desired size of the vocab, at least the current size.
+            num_workers (int, optional): Number of worker processes to train with, as in `train_counts`. Defaults to None.
+
+        Raises:
+            ValueError: If the vocab size is smaller than the current one.
+        """
+
+        first_id = 256 + len(self.units) + len(self.merges)
+        if vocab_size < first_id:
+            raise ValueError(self.extend.__name__ + f": vocab size {vocab_size} is smaller than the current size {first_id}")
+
+        # Statistics are only updated once the new merges are learnt, so a failed extension leaves them as is.
+        word_counts = collections.Counter(self.training_counts())
+        word_counts.update(data)
+
+        words   = [ self.apply_merges(self.initial_tokens(word)) for word in word_counts ]
+        weights = list(word_counts.values())
+
+        if num_workers is not None and num_workers > 1:
+            index = ShardedPairIndex(words, weights, num_workers)
+            try:
+                merges = learn_merges(index, vocab_size - first_id, first_id)
+            finally:
+                index.close()
+        else:
+            merges = learn_merges(PairIndex(words, weights), vocab_size - first_id, first_id)
+        self.merges.update(merges)
+        self.word_counts = word_counts
+        self.build_vocab()
+
+    def learn_units(self, word_counts, vocab_size):
+        """ Learns the initial tokens used in addition to bytes, as per the pre-tokenization strategy.
+            With 'akshara' pre-tokenization, multi-byte aksharas occurring at least `MIN_UNIT_COUNT` times
+            become tokens, most frequent first, taking up at most `MAX_UNIT_SHARE` of the learnt vocabulary.
+            Does nothing otherwise.
+
+        Args:
+            word_counts (dict[str, int]): Mapping of unique strings to their number of occurrences.
+            vocab_size (int): Final desired size of the vocab to be learnt.
+        """
+
+        self.units = {}
+        if self.pretokenize != 'akshara':
+            return
+
+        akshara_counts = collections.Counter()
+        for word, count in word_counts.items():
+            for akshara in split_aksharas(word):
+                if len(data := akshara.encode('utf-8')) > 1:
+                    akshara_counts[data] += count
+
+        # Units are learnt from scratch and shared with no other token, so an uncapped set of units
+        # leaves no merges, and the remaining aksharas fall back to bytes.
+        max_units = int(max(0, vocab_size - 256) * self.MAX_UNIT_SHARE)
+        frequent  = [ akshara for akshara, count in akshara_counts.most_common(max_units) if count >= self.MIN_UNIT_COUNT ]
+        for idx, akshara in enumerate(frequent, start=256):
+            self.units[akshara] = idx
+
+    def initial_tokens(self, string):
+        """ Converts a string to its initial tokens, before merges: pre-tokenized units where known, else bytes.
+
+        Args:
+            string (str): String to convert.
+
+        Returns:
+            list[int]: Initial tokens of the string.
+        """
+
+        if not self.units:
+            return list(string.encode('utf-8'))
+
+        tokens = []
+        for akshara in split_aksharas(string):
+            data = akshara.encode('utf-8')
+            if (unit := self.units.get(data)) is not None:
+                tokens.append(unit)
+            else:
+                tokens.extend(data)
+        return tokens
+
+    def build_vocab(self):
+        """ Builds the id to bytes vocabulary from the learnt merge rules. Invalidates cached results. """
+
         self.vocab = {idx: bytes([idx]) for idx in range(256)}
+        for unit, idx in self.units.items():
+            self.vocab[idx] = unit
         for (p0, p1), idx in self.merges.items():
             self.vocab[idx] = self.vocab[p0] + self.vocab[p1]
-        # END CODE
-
+        self.build_lookup_tables()
+        self.clear_cache()
 
     def pad(self, tokens, length):
         """ Pads a tokenized string to a specified length, for batch processing.
@@ -306,12 +1278,7 @@ class Tokenizer:
 
         start_padding =[]
         end_padding =[]
-        padding = []
-        get_vocab = self.get_vocabulary()
-        if self.add_start and self.add_end:
-            padding = [get_vocab[self.pad_token]] *pad_length
-        else:
-            padding = [get_vocab[self.pad_token]] * pad_length
+        padding = [self.pad_token_id] * pad_length
 
         padded = tokens[:-1]+padding
         end_padding.append(tokens[-1])
@@ -320,11 +1287,12 @@ class Tokenizer:
 
         # END CODE
 
-    def unpad(self, tokens):
+    def unpad(self, tokens, strip_special=False):
         """ Removes padding from a token string.
 
         Args:
             tokens (list[int]): Encoded token string with padding.
+            strip_special (bool, optional): If true, also removes the start and end of sequence tokens. Defaults to False.
 
         Returns:
             list[int]: Token string with padding removed.
@@ -333,14 +1301,11 @@ class Tokenizer:
         # BEGIN CODE : tokenizer.unpad
 
         # ADD YOUR CODE HERE
-        try:
-            if self.strip_special:
-                tokens = tokens[1:]
-                tokens = tokens[:-1]
-            first_pad_index = tokens.index(self.pad_token)
-            tokens = tokens[:first_pad_index]
-        except ValueError:
-            return tokens
+        # Padding is placed before the last token (see `pad`), so it is filtered out rather than truncated.
+        tokens = [ token for token in tokens if token != self.pad_token_id ]
+        if strip_special:
+            tokens = tokens[1:-1]
+        return tokens
 
         # END CODE
 
@@ -355,11 +1320,10 @@ class Tokenizer:
         # BEGIN CODE : tokenizer.get_special_tokens
 
         # ADD YOUR CODE HERE
-        get_vocab =self.get_vocabulary()
-        token_dict = {self.SOT_token : get_vocab[self.SOT_token],self.EOT_token : get_vocab[self.EOT_token]}
-        return token_dict
+        return self.special_token_ids
         # END CODE
-def get_vocabulary(self):
+
+    def get_vocabulary(self):
         """ Returns the learnt vocabulary post the training process.
 
             Returns:
@@ -370,11 +1334,7 @@ def get_vocabulary(self):
         # BEGIN CODE : tokenizer.get_vocabulary
 
         # ADD YOUR CODE HERE
-        self.get_vocab={}
-        for key, value in self.vocab.items():
-           self.get_vocab[value] = key
-
-        return self.get_vocab
+        return self.token_ids
         # END CODE
 
     def encode(self, string, add_start=True, add_end=True):
@@ -391,6 +1351,11 @@ def get_vocabulary(self):
         # BEGIN CODE : tokenizer.encode
 
         # ADD YOUR CODE HERE
+        if self.cache_size:
+            key = (string, add_start, add_end)
+            if (cached := self._cache_lookup('encode', key)) is not None:
+                return list(cached)
+
         start =  self.SOT_token.decode('utf-8')
         end = self.EOT_token.decode('utf-8')
 
@@ -398,14 +1363,10 @@ def get_vocabulary(self):
             string = start +string
         if add_end:
             string = string+end
-        tokens = list(string.encode("utf-8"))
-        while len(tokens) >= 2:
-            stats = self.get_stats(tokens)
-            pair = min(stats, key=lambda p: self.merges.get(p, float("inf")))
-            if pair not in self.merges:
-                break # nothing else can be merged
-            idx = self.merges[pair]
-            tokens = self.merge(tokens, pair, idx)
+        tokens = self.apply_merges(self.initial_tokens(string))
+
+        if self.cache_size:
+            self._cache_store('encode', key, tuple(tokens))
         return tokens
         # END CODE
 
@@ -422,16 +1383,26 @@ def get_vocabulary(self):
         """
 
         # BEGIN CODE : tokenizer.decode
+        # Only plain sequences of ids make for usable cache keys (tensors hash by identity).
+        use_cache = self.cache_size and isinstance(tokens, (list, tuple))
+        if use_cache:
+            key = (tuple(tokens), strip_special)
+            if (cached := self._cache_lookup('decode', key)) is not None:
+                return cached
+
         if strip_special:
             tokens = tokens[1:-1]
         # ADD YOUR CODE HERE
         tks = b"".join(self.vocab[idx] for idx in tokens)
         text = tks.decode("utf-8", errors="replace")
+
+        if use_cache:
+            self._cache_store('decode', key, text)
         return text
         # END CODE
 
 
-    def batch_encode(self, batch, padding=None, add_start=True, add_end=True):
+    def batch_encode(self, batch, padding=None, add_start=True, add_end=True, return_tensors=None, return_mask=False):
         """Encodes multiple strings in a batch to list of tokens padded to a given size.
 
         Args:
@@ -439,12 +1410,22 @@ def get_vocabulary(self):
             padding (int, optional): Optional, desired tokenized length. Outputs will be padded to fit this length.
             add_start (bool): If true, adds the start of sequence token.
             add_end (bool): If true, adds the end of sequence token.
+            return_tensors (str, optional): If 'np' or 'pt', writes the tokens directly into a preallocated
+                NumPy array or torch tensor of shape [batch_size, length], padded as by `pad`. The length is
+                `padding` if given, else the longest tokenized length in the batch. Defaults to None.
+            return_mask (bool, optional): If true and returning tensors, also returns a mask that is true
+                on non-padding positions. Defaults to False.
 
         Returns:
             list[list[int]]: List of tokenized outputs, padded to the same length.
+                If returning tensors, a tuple of the token ids, the unpadded lengths, and optionally the mask.
+
+        Raises:
+            ValueError: If returning tensors and a string does not fit in the given padding length.
         """
-        self.add_start = add_start
-        self.add_end =  add_end
+        if return_tensors is not None:
+            return self._batch_encode_tensors(batch, padding, add_start, add_end, return_tensors, return_mask)
+
         batch_output = [ self.encode(string, add_start, add_end) for string in batch ]
         if padding:
             for i, tokens in enumerate(batch_output):
@@ -452,26 +1433,147 @@ def get_vocabulary(self):
                     batch_output[i] = self.pad(tokens, padding)
         return batch_output
 
-    def batch_decode(self, batch, strip_special=True):
+    def _batch_encode_tensors(self, batch, padding, add_start, add_end, return_tensors, return_mask):
+        """ Encodes a batch into a preallocated array, following the same layout as `pad`.
+            See `batch_encode` for the arguments. """
+
+        # Strings never take more tokens than bytes, which bounds the width when padding to the longest.
+        capacity = padding or max(
+            (len(string.encode('utf-8')) + add_start + add_end for string in batch), default=0
+        )
+
+        pad_id    = self.pad_token_id
+        token_ids = numpy.full((len(batch), capacity), pad_id, dtype=numpy.int64)
+        lengths   = numpy.zeros(len(batch), dtype=numpy.int64)
+        last_ids  = numpy.full(len(batch), pad_id, dtype=numpy.int64)
+
+        for i, string in enumerate(batch):
+            tokens = self.encode(string, add_start, add_end)
+            if len(tokens) > capacity:
+                raise ValueError(self.batch_encode.__name__ + f": {string!r} does not fit in {capacity} tokens")
+            if tokens:
+                token_ids[i, :len(tokens)-1] = tokens[:-1]
+                last_ids[i], lengths[i] = tokens[-1], len(tokens)
+
+        # The last token always occupies the final position, after any padding.
+        width     = padding or int(lengths.max(initial=0))
+        token_ids = numpy.ascontiguousarray(token_ids[:, :width])
+        if width:
+            token_ids[:, width-1] = last_ids
+        outputs = [ token_ids, lengths ]
+
+        if return_mask:
+            mask = numpy.arange(width)[None, :] < (lengths - 1)[:, None]
+            if width:
+                mask[:, width-1] = lengths > 0
+            outputs.append(mask)
+
+        if return_tensors == 'pt':
+            outputs = [ torch.from_numpy(output) for output in outputs ]
+        return tuple(outputs)
+
+    def batch_decode(self, batch, strip_special=True, lengths=None):
         """ Decodes a batch of encoded tokens to normal strings.
 
+            A 2-D array or tensor of tokens is decoded in a vectorized manner: padding and (optionally)
+            special tokens are masked out wherever they occur, and the bytes of the remaining tokens
+            are gathered from a flat byte table of the vocabulary.
+
         Args:
-            batch (list[list[int]]): List of encoded token strings, optionally padded.
+            batch (list[list[int]]|numpy.ndarray|torch.Tensor): List of encoded token strings, optionally padded,
+                or a 2-D array of token ids of shape [batch_size, length].
             strip_special (bool): Whether to remove special tokens or not.
+            lengths (list[int]|numpy.ndarray|torch.Tensor, optional): For 2-D arrays, number of tokens per row,
+                laid out as by `pad`: all but the last at the start of the row, and the last in the final position.
+                Matches the lengths returned by `batch_encode`. Defaults to all positions.
 
         Returns:
             list[str]: Decoded strings after padding is removed.
         """
-        self.strip_special =strip_special
+        if isinstance(batch, (numpy.ndarray, torch.Tensor)) and batch.ndim == 2:
+            return self._batch_decode_array(batch, strip_special, lengths)
+
         return [ self.decode(self.unpad(tokens), strip_special=strip_special) for tokens in batch ]
 
+    def _batch_decode_array(self, batch, strip_special, lengths):
+        """ Decodes a 2-D array of token ids, see `batch_decode` for the arguments. """
+
+        if isinstance(batch, torch.Tensor):
+            batch = batch.detach().cpu().numpy()
+        if isinstance(lengths, torch.Tensor):
+            lengths = lengths.detach().cpu().numpy()
+
+        num_rows, width = batch.shape
+        keep = batch != self.pad_token_id
+        if lengths is not None:
+            lengths = numpy.asarray(lengths)
+            in_row  = numpy.arange(width)[None, :] < (lengths - 1)[:, None]
+            if width:
+                in_row[:, width-1] = lengths > 0
+            keep &= in_row
+        if strip_special:
+            keep &= ~numpy.isin(batch, list(self.special_token_ids.values()))
+
+        # Kept tokens in row-major order, each expanded to the indices of its bytes in the flat table.
+        tokens = batch[keep]
+        starts = self._vocab_offsets[tokens]
+        sizes  = self._vocab_offsets[tokens + 1] - starts
+        ends   = numpy.cumsum(sizes)
+        byte_index = numpy.repeat(starts - (ends - sizes), sizes) + numpy.arange(ends[-1] if len(ends) else 0)
+        data = self._vocab_bytes[byte_index].tobytes()
+
+        row_sizes  = numpy.bincount(numpy.nonzero(keep)[0], weights=sizes, minlength=num_rows).astype(numpy.int64)
+        row_bounds = numpy.concatenate(([ 0 ], numpy.cumsum(row_sizes))).tolist()
+        return [
+            data[start:end].decode('utf-8', errors='replace')
+            for start, end in zip(row_bounds[:-1], row_bounds[1:])
+        ]
+
+    def encode_corpus(self, strings, add_start=True, add_end=True, num_workers=None, chunksize=16384):
+        """ Encodes a whole corpus, splitting it into chunks that are encoded in a pool of worker processes.
+            The tokenizer is sent once to every worker, and results are gathered in input order.
+
+        Args:
+            strings (str|Iterable[str]): Strings to encode, or the path to a CSV file with a 'Name' column.
+            add_start (bool): If true, adds the start of sequence token.
+            add_end (bool): If true, adds the end of sequence token.
+            num_workers (int, optional): Number of worker processes. Encodes in this process if 1.
+                Defaults to the number of CPUs.
+            chunksize (int, optional): Number of strings per task sent to a worker. Defaults to 16384.
+
+        Returns:
+            tuple[numpy.ndarray, numpy.ndarray]: Flat buffer of the tokens of all strings (int32),
+                and offsets (int64) such that the tokens of string i are `tokens[offsets[i]:offsets[i+1]]`.
+        """
+
+        chunks = iter_string_chunks(strings, chunksize=chunksize)
+        num_workers = num_workers or os.cpu_count()
+
+        if num_workers == 1:
+            results = [ _encode_chunk(chunk, add_start, add_end, self) for chunk in chunks ]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                num_workers, initializer=_init_encode_worker, initargs=(self,)
+            ) as executor:
+                results = list(executor.map(
+                    _encode_chunk, chunks, itertools.repeat(add_start), itertools.repeat(add_end)
+                ))
+
+        tokens  = numpy.concatenate([ chunk_tokens for chunk_tokens, _ in results ] or [ numpy.zeros(0, dtype=numpy.int32) ])
+        lengths = numpy.concatenate([ chunk_lengths for _, chunk_lengths in results ] or [ numpy.zeros(0, dtype=numpy.int64) ])
+        offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        return tokens, offsets
+
 ## ==== END EVALUATION PORTION
 
 """Now with the tokenizer class, initialize and train the tokenizers for processing the parallel corpus:"""
 # Initialize the tokenizers as per the desired strategy.
 # ADD YOUR CODE HERE
-src_tokenizer = Tokenizer(namecol)
-tgt_tokenizer = Tokenizer(transcol)
+src_tokenizer = Tokenizer(namecol, cache_size=50000)
+# Akshara pre-tokenization (pretokenize='akshara') gave slightly longer target sequences than byte-level BPE
+# on names, at every vocabulary size tried, so byte-level BPE is used for both sides.
+tgt_tokenizer = Tokenizer(transcol, cache_size=50000)
 
 # END CODE
 
@@ -487,8 +1589,9 @@ TGT_VOCAB_SIZE = 1000
 
 # Train your tokenizer(s)
 # ADD YOUR CODE HERE
-src_tokenizer.train(namecol,SRC_VOCAB_SIZE)
-tgt_tokenizer.train(transcol,TGT_VOCAB_SIZE)
+# Training data holds unique pairs, so strings are weighted by how often they occur in the source data.
+src_tokenizer.train_counts(train_data.groupby('Name', sort=False)['Count'].sum().to_dict(), SRC_VOCAB_SIZE)
+tgt_tokenizer.train_counts(train_data.groupby('Translation', sort=False)['Count'].sum().to_dict(), TGT_VOCAB_SIZE)
 print("source vocab length:",SRC_VOCAB_SIZE)
 print("target vocablength:",TGT_VOCAB_SIZE)
 # END CODE
@@ -628,6 +1731,262 @@ except AssertionError:
         "ensure you have used start and end tokens appropriately!"
     ))
 
+# Check that arrays from `batch_encode` decode back to the original strings, with and without the returned lengths.
+
+try:
+    token_ids, lengths = tgt_tokenizer.batch_encode(
+        instances, padding=max_length, add_start=False, add_end=False, return_tensors='np'
+    )
+    assert tgt_tokenizer.batch_decode(token_ids, lengths=lengths) == instances
+    assert tgt_tokenizer.batch_decode(token_ids, strip_special=False, lengths=lengths) == instances
+    assert tgt_tokenizer.batch_decode(token_ids) == instances
+
+except AssertionError:
+    print((
+        "[!] Your tokenizer does not decode batches correctly, "
+        "ensure that arrays are decoded with the same layout as they are padded!"
+    ))
+
+# Check that a single tokenizer can be shared across threads: concurrent batches
+#   with different flags must give the same results as running them one at a time.
+
+instances = train_data['Translation'].sample(n=2000, random_state=20240227).tolist()
+configurations = [
+    dict(add_start=add_start, add_end=add_end, strip_special=strip_special)
+    for add_start in (False, True) for add_end in (False, True) for strip_special in (False, True)
+]
+
+def encode_decode_batch(task):
+    batch, configuration = instances[task*50:(task+1)*50], configurations[task % len(configurations)]
+    tokenized = tgt_tokenizer.batch_encode(
+        batch, padding=24, add_start=configuration['add_start'], add_end=configuration['add_end']
+    )
+    return tokenized, tgt_tokenizer.batch_decode(tokenized, strip_special=configuration['strip_special'])
+
+try:
+    expected = [ encode_decode_batch(task) for task in range(len(instances) // 50) ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        for _ in range(10):
+            tasks = list(range(len(instances) // 50))
+            assert list(executor.map(encode_decode_batch, tasks)) == expected
+
+except AssertionError:
+    print((
+        "[!] Your tokenizer gives different results when shared between threads, "
+        "ensure it does not keep per-call state!"
+    ))
+
+"""To compare tokenizer changes and pick vocabulary sizes from data, we benchmark training time, encoding and decoding throughput, peak memory and compression over synthetic and real name corpora:"""
+
+def synthetic_names(count, alphabet, min_length=3, max_length=12, seed=0):
+    """ Generates random names over a given alphabet, as a synthetic corpus for benchmarks.
+
+    Args:
+        count (int): Number of names to generate.
+        alphabet (str|list[str]): Characters (or longer units) to draw from, uniformly.
+        min_length (int, optional): Minimum number of units per name. Defaults to 3.
+        max_length (int, optional): Maximum number of units per name. Defaults to 12.
+        seed (int, optional): Seed for the random generator. Defaults to 0.
+
+    Returns:
+        list[str]: Generated names.
+    """
+
+    generator, alphabet = random.Random(seed), list(alphabet)
+    return [
+        "".join(generator.choices(alphabet, k=generator.randint(min_length, max_length)))
+        for _ in range(count)
+    ]
+
+def _best_time(function, repeats):
+    """ Returns the best wall-clock time of a function over a number of runs, along with its last result. """
+
+    best, result = math.inf, None
+    for _ in range(repeats):
+        start  = time.perf_counter()
+        result = function()
+        best   = min(best, time.perf_counter() - start)
+    return best, result
+
+def _peak_memory(function):
+    """ Returns the peak memory allocated by Python while running a function, in bytes. """
+
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark_tokenizer(corpora, corpus_sizes, vocab_sizes, output_file=None, tokenizer_options=None,
+                        train_options=None, repeats=3, seed=0):
+    """ Benchmarks tokenizer training, encoding and decoding across corpora, corpus sizes and vocabulary sizes.
+
+        For every combination, reports the training time and peak memory, the throughput of `encode`,
+            `batch_encode` and `decode` in names per second, and the compression in tokens per name
+            (without special tokens) and bytes per token. Caching is disabled, to measure the encoders themselves.
+        Times are the best over several runs, and peak memory is measured in a separate, traced run.
+
+    Args:
+        corpora (dict[str, list[str]]): Named corpora to benchmark on. Corpora are sampled with replacement
+            when smaller than a requested corpus size.
+        corpus_sizes (list[int]): Numbers of names to train and encode with.
+        vocab_sizes (list[int]): Vocabulary sizes to train.
+        output_file (str, optional): Path to write the results to, as JSON. Defaults to None (not written).
+        tokenizer_options (dict[str, dict], optional): Keyword arguments for `Tokenizer`, per corpus name. Defaults to None.
+        train_options (dict, optional): Keyword arguments for `Tokenizer.train`. Defaults to None.
+        repeats (int, optional): Number of timed runs per measurement. Defaults to 3.
+        seed (int, optional): Seed for sampling corpora. Defaults to 0.
+
+    Returns:
+        dict: Environment details, and a list of results, one per corpus, corpus size and vocabulary size.
+    """
+
+    tokenizer_options, train_options = tokenizer_options or {}, train_options or {}
+    generator = random.Random(seed)
+
+    results = []
+    for corpus_name, corpus in corpora.items():
+        for corpus_size in corpus_sizes:
+            if corpus_size <= len(corpus):
+                data = generator.sample(corpus, corpus_size)
+            else:
+                data = generator.choices(corpus, k=corpus_size)
+            num_bytes = sum(len(name.encode('utf-8')) for name in data)
+
+            for vocab_size in vocab_sizes:
+                options = dict(tokenizer_options.get(corpus_name, {}), cache_size=0)
+                def train():
+                    tokenizer = Tokenizer(data, **options)
+                    tokenizer.train(data, vocab_size, **train_options)
+                    return tokenizer
+
+                train_time, tokenizer = _best_time(train, repeats)
+                train_memory = _peak_memory(train)
+
+                encode_time, encoded = _best_time(lambda: [ tokenizer.encode(name) for name in data ], repeats)
+                batch_time, _        = _best_time(lambda: tokenizer.batch_encode(data), repeats)
+                decode_time, decoded = _best_time(lambda: [ tokenizer.decode(tokens) for tokens in encoded ], repeats)
+                if decoded != data:
+                    raise ValueError(benchmark_tokenizer.__name__ + f": round-trip failed on corpus {corpus_name!r}")
+
+                num_tokens = sum(len(tokens) for tokens in tokenizer.batch_encode(data, add_start=False, add_end=False))
+                results.append({
+                    'corpus': corpus_name,
+                    'corpus_size': corpus_size,
+                    'corpus_bytes': num_bytes,
+                    'vocab_size': vocab_size,
+                    'learnt_vocab_size': len(tokenizer.vocab),
+                    'train_seconds': train_time,
+                    'train_peak_memory_bytes': train_memory,
+                    'encode_names_per_second': corpus_size / encode_time,
+                    'batch_encode_names_per_second': corpus_size / batch_time,
+                    'decode_names_per_second': corpus_size / decode_time,
+                    'tokens_per_name': num_tokens / corpus_size,
+                    'bytes_per_token': num_bytes / max(num_tokens, 1),
+                })
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'tokenizer_options': tokenizer_options,
+        'train_options': train_options,
+        'repeats': repeats,
+        'results': results,
+    }
+    if output_file is not None:
+        with open(output_file, "w+", encoding='utf-8') as ofile:
+            json.dump(report, ofile, ensure_ascii=False, indent=2)
+    return report
+
+# Set to True to measure tokenizer training and encoding, and write tokenizer_benchmark.json.
+# Off by default, as it trains dozens of tokenizers and raises on round-trip failures.
+RUN_TOKENIZER_BENCHMARK = False
+
+if RUN_TOKENIZER_BENCHMARK:
+    benchmark_report = benchmark_tokenizer(
+        corpora = {
+            'names'            : namecol,
+            'translations'     : transcol,
+            'synthetic-latin'  : synthetic_names(len(namecol), "abcdefghijklmnopqrstuvwxyz"),
+            'synthetic-hindi'  : synthetic_names(len(transcol), sorted(set("".join(transcol)))),
+        },
+        corpus_sizes      = [ 1000, 10000 ],
+        vocab_sizes       = [ 300, 500, 1000, 2000 ],
+        output_file       = os.path.join(DIRECTORY_NAME, "tokenizer_benchmark.json"),
+        tokenizer_options = { 'translations': { 'pretokenize': 'akshara' }, 'synthetic-hindi': { 'pretokenize': 'akshara' } },
+        repeats           = 1,
+    )
+
+    for result in benchmark_report['results']:
+        print(
+            f"{result['corpus']:>16} | {result['corpus_size']:>6} names | vocab {result['vocab_size']:>5} | "
+            f"train {result['train_seconds']:7.2f}s | encode {result['encode_names_per_second']:9.0f}/s | "
+            f"{result['tokens_per_name']:5.2f} tokens/name"
+        )
+
+"""Strings of the dataset are stored in contiguous columns, so that instances and batches are fetched without pandas indexing:"""
+
+class StringColumn:
+    """ Read-only column of strings, stored as one contiguous UTF-8 buffer and per-string offsets (as in Arrow).
+        Indexing is always positional, and batches of strings can be fetched at once. """
+
+    def __init__(self, strings):
+        """ Initializes the column.
+
+        Args:
+            strings (Iterable[str]): Strings to store, e.g., a DataFrame column.
+        """
+
+        encoded = [ str(string).encode('utf-8') for string in strings ]
+        self.buffer  = numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)
+        self.offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([ len(string) for string in encoded ], out=self.offsets[1:])
+
+    def __len__(self):
+        """ Returns the number of strings in the column. """
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """ Returns the string at a given position.
+
+        Args:
+            index (int): Position of the string.
+
+        Returns:
+            str: String at the position.
+        """
+
+        if index < 0:
+            index += len(self)
+        return self.buffer[self.offsets[index]:self.offsets[index+1]].tobytes().decode('utf-8')
+
+    def take(self, indices):
+        """ Returns the strings at the given positions.
+
+        Args:
+            indices (list[int]|numpy.ndarray): Positions of the strings.
+
+        Returns:
+            list[str]: Strings at the positions, in order.
+        """
+
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        indices = numpy.where(indices < 0, indices + len(self), indices)
+        view    = memoryview(self.buffer)
+        return [
+            str(view[start:end], 'utf-8')
+            for start, end in zip(self.offsets[indices].tolist(), self.offsets[indices + 1].tolist())
+        ]
+
+    def __iter__(self):
+        """ Iterates over all strings in the column, in order. """
+        return iter(self.take(numpy.arange(len(self))))
+
 """We now abstract away the tokenizer into a pytorch compatible TokenizedDataset that will handle the tokenization internally:"""
 
 # Please do not change anything in the following cell
@@ -647,6 +2006,9 @@ class TokenizerDataset(TensorDataset):
         """
 
         self.data = data
+        # Converted once into contiguous columns, so that items are served by position without pandas indexing.
+        self.names        = StringColumn(data['Name'])
+        self.translations = StringColumn(data['Translation'])
         self.src_tokenizer = src_tokenizer
         self.tgt_tokenizer = tgt_tokenizer
         self.src_padding = src_padding
@@ -665,18 +2027,17 @@ class TokenizerDataset(TensorDataset):
         x_batch = [ data[0] for data in batch ]
         y_batch = [ data[1] for data in batch ]
 
-        x_batch = self.src_tokenizer.batch_encode(x_batch, self.src_padding)
-        y_batch = self.tgt_tokenizer.batch_encode(y_batch, self.tgt_padding)
-
         if self.src_padding is None:
+            x_batch = self.src_tokenizer.batch_encode(x_batch)
             x_batch = torch.nn.utils.rnn.pack_sequence([ torch.tensor(tokens) for tokens in x_batch ], False)
         else:
-            x_batch = torch.tensor(x_batch)
+            x_batch, _ = self.src_tokenizer.batch_encode(x_batch, self.src_padding, return_tensors='pt')
 
         if self.tgt_padding is None:
+            y_batch = self.tgt_tokenizer.batch_encode(y_batch)
             y_batch = torch.nn.utils.rnn.pack_sequence([ torch.tensor(tokens) for tokens in y_batch ], False)
         else:
-            y_batch = torch.tensor(y_batch)
+            y_batch, _ = self.tgt_tokenizer.batch_encode(y_batch, self.tgt_padding, return_tensors='pt')
 
         return x_batch, y_batch
 
@@ -691,10 +2052,33 @@ class TokenizerDataset(TensorDataset):
         """
 
         return (
-            self.data['Name'][index],
-            self.data['Translation'][index]
+            self.names[index],
+            self.translations[index]
         )
 
+    def __getitems__(self, indices):
+        """ Returns the instances at the given positions at once, as used by dataloaders to fetch whole batches.
+
+        Args:
+            indices (list[int]): Positions of the instances to retrieve.
+
+        Returns:
+            list[tuple[str, str]]: Untokenized instance pairs.
+        """
+
+        return list(zip(self.names.take(indices), self.translations.take(indices)))
+
+    def instance_counts(self):
+        """ Returns the number of occurrences of every instance in the source data, as merged by `prepare_dataframe`.
+
+        Returns:
+            numpy.ndarray: Counts from the 'Count' column of the data, one per instance, or ones if there is none.
+        """
+
+        if 'Count' in self.data:
+            return numpy.asarray(self.data['Count'], dtype=numpy.int64)
+        return numpy.ones(len(self), dtype=numpy.int64)
+
     def __len__(self):
 
         """ Returns the length of the dataset.
@@ -702,7 +2086,304 @@ class TokenizerDataset(TensorDataset):
         Returns:
             int: Length of the dataset.
         """
-        return len(self.data)
+        return len(self.names)
+
+"""Datasets that tokenize ahead of training, or stream from files, and a sampler that batches instances of similar length:"""
+
+class CachedTokenizerDataset(TokenizerDataset):
+    """ A TokenizerDataset that tokenizes all instances once, ahead of training, instead of in every batch.
+
+        Token ids and offsets are stored in a memory-mapped cache file, named after a hash of both tokenizers
+            and of the data, so that later runs over the same data reuse it. Instances are indices into the cache,
+            and collation only gathers and pads their tokens.
+    """
+
+    CACHE_MAGIC   = b'TOKDATA\0'
+    CACHE_VERSION = 1
+
+    def __init__(self, data, src_tokenizer, tgt_tokenizer, src_padding=None, tgt_padding=None,
+                 cache_dir=None, num_workers=None, dynamic_padding=False):
+        """ Initializes the dataset, tokenizing the data unless a matching cache file exists.
+
+        Args:
+            data: DataFrame of input and output strings.
+            src_tokenizer (Tokenizer): Tokenizer for the source language.
+            tgt_tokenizer (Tokenizer): Tokenizer for the target language.
+            src_padding (int, optional): Padding length for the source text. Defaults to None.
+            tgt_padding (int, optional): Padding length for the target text. Defaults to None.
+            cache_dir (str, optional): Directory to keep cache files in. Defaults to a 'dataset-cache' directory
+                within DIRECTORY_NAME.
+            num_workers (int, optional): Number of processes to tokenize with, as in `Tokenizer.encode_corpus`.
+                Defaults to None.
+            dynamic_padding (bool, optional): If true, every batch is only padded to its longest instance,
+                with the padding lengths as upper bounds. Defaults to False.
+        """
+
+        super().__init__(data, src_tokenizer, tgt_tokenizer, src_padding, tgt_padding)
+        self.dynamic_padding = dynamic_padding
+        self.pad_token_ids   = (src_tokenizer.pad_token_id, tgt_tokenizer.pad_token_id)
+
+        digest = hashlib.sha256()
+        digest.update(src_tokenizer.fingerprint().encode('utf-8'))
+        digest.update(tgt_tokenizer.fingerprint().encode('utf-8'))
+        for column in (self.names, self.translations):
+            digest.update(column.offsets.tobytes())
+            digest.update(column.buffer.tobytes())
+
+        cache_dir = cache_dir or os.path.join(DIRECTORY_NAME, "dataset-cache")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_file = os.path.join(cache_dir, f"{digest.hexdigest()}.bin")
+
+        if not os.path.exists(self.cache_file):
+            src_tokens, src_offsets = src_tokenizer.encode_corpus(list(self.names), num_workers=num_workers)
+            tgt_tokens, tgt_offsets = tgt_tokenizer.encode_corpus(list(self.translations), num_workers=num_workers)
+            # Written under a temporary name first, so that an interrupted run never leaves a partial cache behind.
+            partial_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            write_sectioned_file(partial_file, self.CACHE_MAGIC, self.CACHE_VERSION, { 'size': len(data) }, {
+                'src_tokens': src_tokens, 'src_offsets': src_offsets,
+                'tgt_tokens': tgt_tokens, 'tgt_offsets': tgt_offsets,
+            })
+            os.replace(partial_file, self.cache_file)
+
+        self.load_cache()
+
+    def load_cache(self):
+        """ Memory-maps the token arrays from the cache file. """
+        _, _, self.sections = read_sectioned_file(self.cache_file, self.CACHE_MAGIC, self.CACHE_VERSION)
+
+    def __getstate__(self):
+        """ Returns the state to serialize, without the mapped arrays, which are mapped again on deserialization.
+            Tokenizers and strings are left out as well, since collation only needs the cache file and the pad ids:
+            this keeps copies sent to DataLoader worker processes small. """
+        state = self.__dict__.copy()
+        for transient in ('sections', 'src_tokenizer', 'tgt_tokenizer', 'data', 'names', 'translations'):
+            state.pop(transient, None)
+        return state
+
+    def __setstate__(self, state):
+        """ Restores a serialized state, mapping the cache file again. """
+        self.__dict__.update(state)
+        self.src_tokenizer, self.tgt_tokenizer = None, None
+        self.data, self.names, self.translations = None, None, None
+        self.load_cache()
+
+    def token_lengths(self):
+        """ Returns the token length of every instance, as the longer of its source and target lengths.
+
+        Returns:
+            numpy.ndarray: Token lengths, one per instance.
+        """
+
+        return numpy.maximum(numpy.diff(self.sections['src_offsets']), numpy.diff(self.sections['tgt_offsets']))
+
+    def _collate_side(self, indices, side, padding, pad_id):
+        """ Gathers the tokens of one side of the given instances, padded or as a packed sequence. """
+
+        tokens, offsets = self.sections[f'{side}_tokens'], self.sections[f'{side}_offsets']
+        if padding is None:
+            return torch.nn.utils.rnn.pack_sequence([
+                torch.from_numpy(tokens[offsets[index]:offsets[index+1]].astype(numpy.int64)) for index in indices
+            ], False)
+        if self.dynamic_padding:
+            indices = numpy.asarray(indices, dtype=numpy.int64)
+            padding = min(padding, int((offsets[indices + 1] - offsets[indices]).max(initial=1)))
+        token_ids, _ = pad_token_slices(tokens, offsets, indices, padding, pad_id)
+        return torch.from_numpy(token_ids)
+
+    def collate(self, batch):
+        """ Collates data instances into a batch of tokenized tensors.
+
+        Args:
+            batch (list[int]): List of instance indices.
+
+        Returns:
+            tuple[torch.Tensor|PackedSequence, torch.Tensor|PackedSequence]: pair of tokenized tensors.
+        """
+
+        return (
+            self._collate_side(batch, 'src', self.src_padding, self.pad_token_ids[0]),
+            self._collate_side(batch, 'tgt', self.tgt_padding, self.pad_token_ids[1]),
+        )
+
+    def __getitem__(self, index):
+        """ Returns the nth instance from the dataset, as its index in the cache. Strings are in `names` and `translations`.
+
+        Args:
+            index (int): Index of the instance to retrieve.
+
+        Returns:
+            int: Index of the instance, to collate.
+        """
+
+        return index
+
+    def __getitems__(self, indices):
+        """ Returns the instances at the given positions at once, as their indices in the cache.
+
+        Args:
+            indices (list[int]): Positions of the instances to retrieve.
+
+        Returns:
+            list[int]: Indices of the instances, to collate.
+        """
+
+        return list(indices)
+
+    def __len__(self):
+        """ Returns the length of the dataset, from the cache so that it is also known to worker copies.
+
+        Returns:
+            int: Length of the dataset.
+        """
+        return len(self.sections['src_offsets']) - 1
+
+class StreamingTokenizerDataset(torch.utils.data.IterableDataset):
+    """ Streams tokenized instance pairs from CSV or JSON Lines shards, for corpora that do not fit in memory.
+
+        Shards are read in chunks and shuffled approximately, through a bounded shuffle buffer, so memory use
+            depends on the chunk and buffer sizes only. Shards are split across DataLoader worker processes,
+            or rows are when there are fewer shards than workers, so every instance is read once per epoch.
+    """
+
+    def __init__(self, shards, src_tokenizer, tgt_tokenizer, src_padding=None, tgt_padding=None,
+                 shuffle_buffer=16384, chunksize=4096):
+        """ Initializes the dataset.
+
+        Args:
+            shards (str|list[str]): Paths of CSV or JSON Lines files with 'Name' and 'Translation' columns.
+            src_tokenizer (Tokenizer): Tokenizer for the source language.
+            tgt_tokenizer (Tokenizer): Tokenizer for the target language.
+            src_padding (int, optional): Padding length for the source text. Defaults to None.
+            tgt_padding (int, optional): Padding length for the target text. Defaults to None.
+            shuffle_buffer (int, optional): Number of instances to shuffle among. Disables shuffling if 0 or 1.
+                Defaults to 16384.
+            chunksize (int, optional): Number of rows to read from a shard at a time. Defaults to 4096.
+        """
+
+        self.shards         = [ shards ] if isinstance(shards, (str, os.PathLike)) else list(shards)
+        self.src_tokenizer  = src_tokenizer
+        self.tgt_tokenizer  = tgt_tokenizer
+        self.src_padding    = src_padding
+        self.tgt_padding    = tgt_padding
+        self.shuffle_buffer = shuffle_buffer
+        self.chunksize      = chunksize
+
+    def _iter_rows(self, generator):
+        """ Yields the rows assigned to the current worker process, with shards in a random order. """
+
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+
+        if len(self.shards) >= num_workers:
+            shards, row_step, row_start = self.shards[worker_id::num_workers], 1, 0
+        else:
+            shards, row_step, row_start = list(self.shards), num_workers, worker_id
+        if self.shuffle_buffer > 1:
+            generator.shuffle(shards)
+
+        for shard in shards:
+            row_index = 0
+            for chunk in iter_pair_chunks(shard, self.chunksize):
+                yield from chunk[(row_start - row_index) % row_step::row_step]
+                row_index += len(chunk)
+
+    def __iter__(self):
+        """ Yields tokenized instance pairs, approximately shuffled.
+
+        Yields:
+            tuple[list[int], list[int]]: Source and target tokens of the next instance.
+        """
+
+        # Seeded from torch, which seeds every worker differently, and every epoch anew.
+        generator = random.Random(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        buffer = []
+        for name, translation in self._iter_rows(generator):
+            instance = (self.src_tokenizer.encode(name), self.tgt_tokenizer.encode(translation))
+            if len(buffer) < max(self.shuffle_buffer, 1):
+                buffer.append(instance)
+                continue
+            # Emit a random buffered instance, and keep the new one in its place.
+            index = generator.randrange(len(buffer))
+            buffer[index], instance = instance, buffer[index]
+            yield instance
+
+        if self.shuffle_buffer > 1:
+            generator.shuffle(buffer)
+        yield from buffer
+
+    def collate(self, batch):
+        """ Collates tokenized instances into a batch of tensors.
+
+        Args:
+            batch (list[tuple[list[int], list[int]]]): List of tokenized x, y pairs.
+
+        Returns:
+            tuple[torch.Tensor|PackedSequence, torch.Tensor|PackedSequence]: pair of tokenized tensors.
+        """
+
+        sides = []
+        for side, padding, tokenizer in ((0, self.src_padding, self.src_tokenizer), (1, self.tgt_padding, self.tgt_tokenizer)):
+            if padding is None:
+                sides.append(torch.nn.utils.rnn.pack_sequence([ torch.tensor(pair[side]) for pair in batch ], False))
+                continue
+            lengths = numpy.fromiter((len(pair[side]) for pair in batch), dtype=numpy.int64, count=len(batch))
+            offsets = numpy.concatenate(([ 0 ], numpy.cumsum(lengths)))
+            tokens  = numpy.fromiter(itertools.chain.from_iterable(pair[side] for pair in batch), dtype=numpy.int64, count=int(offsets[-1]))
+            token_ids, _ = pad_token_slices(tokens, offsets, numpy.arange(len(batch)), padding, tokenizer.pad_token_id)
+            sides.append(torch.from_numpy(token_ids))
+        return tuple(sides)
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """ Batch sampler that groups instances of similar token length, to minimize padding in every batch.
+
+        Instances are grouped into buckets of lengths within a given width. Every epoch, instances are shuffled
+            within their bucket and split into batches, and the batches of all buckets are shuffled together.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_width=1, shuffle=True, counts=None):
+        """ Initializes the sampler.
+
+        Args:
+            lengths (list[int]|numpy.ndarray): Token length of every instance, e.g. from `CachedTokenizerDataset.token_lengths`.
+            batch_size (int): Maximum number of instances per batch.
+            bucket_width (int, optional): Range of lengths grouped in one bucket. Defaults to 1 (equal lengths only).
+            shuffle (bool, optional): If true, shuffles instances and batches every epoch. Defaults to True.
+            counts (list[int]|numpy.ndarray, optional): Number of times to sample every instance per epoch,
+                e.g. from `TokenizerDataset.instance_counts`. Defaults to None (once each).
+        """
+
+        self.batch_size = batch_size
+        self.shuffle    = shuffle
+
+        instances = numpy.arange(len(lengths))
+        if counts is not None:
+            instances = numpy.repeat(instances, counts)
+        keys   = numpy.asarray(lengths, dtype=numpy.int64)[instances] // bucket_width
+        order  = numpy.argsort(keys, kind='stable')
+        bounds = numpy.flatnonzero(numpy.diff(keys[order])) + 1
+        self.buckets = [ bucket for bucket in numpy.split(instances[order], bounds) if len(bucket) ]
+
+    def __len__(self):
+        """ Returns the number of batches per epoch. """
+        return sum(-(-len(bucket) // self.batch_size) for bucket in self.buckets)
+
+    def __iter__(self):
+        """ Yields the batches of an epoch, as lists of instance indices. """
+
+        # Seeded from torch, so that `torch.manual_seed` makes the batches deterministic.
+        generator = numpy.random.default_rng(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = generator.permutation(bucket)
+            batches.extend(bucket[start:start+self.batch_size] for start in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            batches = [ batches[i] for i in generator.permutation(len(batches)) ]
+
+        for batch in batches:
+            yield batch.tolist()
 
 """## Model-Agnostic Training
 
@@ -749,7 +2430,8 @@ class Trainer:
         print(self.optimizer)
 
     @staticmethod
-    def make_dataloader(dataset, shuffle_data=True, batch_size=64, collate_fn=None):
+    def make_dataloader(dataset, shuffle_data=True, batch_size=64, collate_fn=None, bucket_width=None, repeat_counts=False,
+                        num_workers=0, persistent_workers=True, prefetch_factor=2, pin_memory=False):
         """ Create a dataloader for a torch Dataset.
 
         Args:
@@ -757,6 +2439,16 @@ class Trainer:
             shuffle_data (bool, optional): If true, shuffles the data. Defaults to True.
             batch_size (int, optional): Number of items per batch. Defaults to 8.
             collate_fn (function, optional): Function to use for collating instances to a batch.
+            bucket_width (int, optional): If given, batches instances of similar length with a `BucketBatchSampler`
+                of this bucket width. Requires the dataset to provide `token_lengths`. Defaults to None.
+            repeat_counts (bool, optional): If true, samples every instance as many times per epoch as it occurs
+                in the source data, restoring the frequencies of pairs merged by `prepare_dataframe`.
+                Requires the dataset to provide `instance_counts`. Defaults to False.
+            num_workers (int, optional): Number of worker processes to load batches in. Defaults to 0 (in this process).
+            persistent_workers (bool, optional): If true, keeps workers alive across epochs. Defaults to True.
+            prefetch_factor (int, optional): Number of batches loaded ahead by each worker. Defaults to 2.
+            pin_memory (bool, optional): If true and CUDA is available, loads batches into pinned memory,
+                for faster, asynchronous transfers to the GPU. Defaults to False.
 
         Returns:
             torch.utils.data.DataLoader: Dataloader over the given data, post processing.
@@ -765,11 +2457,39 @@ class Trainer:
         # BEGIN CODE : trainer.make_dataloader
 
         # ADD YOUR CODE HERE
+        options = dict(
+            collate_fn=collate_fn,
+            num_workers=num_workers,
+            pin_memory=pin_memory and torch.cuda.is_available()
+            )
+        # Worker options are only accepted when batches are loaded in worker processes.
+        if num_workers > 0:
+            options.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+
+        counts = dataset.instance_counts() if repeat_counts else None
+
+        # Streamed datasets shuffle by themselves, within a bounded buffer.
+        if isinstance(dataset, torch.utils.data.IterableDataset):
+            return DataLoader(dataset, batch_size=batch_size, **options)
+        if bucket_width is not None:
+            return DataLoader(
+                dataset,
+                batch_sampler=BucketBatchSampler(dataset.token_lengths(), batch_size, bucket_width, shuffle_data, counts),
+                **options
+                )
+        if counts is not None:
+            indices = numpy.repeat(numpy.arange(len(dataset)), counts)
+            return DataLoader(
+                dataset,
+                batch_size=batch_size,
+                sampler=torch.utils.data.SubsetRandomSampler(indices) if shuffle_data else indices.tolist(),
+                **options
+                )
         return DataLoader(
             dataset,
             batch_size=batch_size,
             shuffle=shuffle_data,
-            collate_fn=collate_fn
+            **options
             )
         # END CODE
 
@@ -789,7 +2509,7 @@ class Trainer:
         # ADD YOUR CODE HERE
         self.model.train()
         self.optimizer.zero_grad()
-        x_batch, y_batch = x_batch.to(self.device), y_batch.to(self.device)
+        x_batch, y_batch = x_batch.to(self.device, non_blocking=True), y_batch.to(self.device, non_blocking=True)
         outputs = self.model(x_batch)
         loss = self.criterion(outputs, y_batch)
         loss.backward()
@@ -814,7 +2534,7 @@ class Trainer:
         total_loss = 0.0
         with torch.no_grad():
             for x_batch, y_batch in validation_dataloader:
-                x_batch, y_batch = x_batch.to(self.device), y_batch.to(self.device)
+                x_batch, y_batch = x_batch.to(self.device, non_blocking=True), y_batch.to(self.device, non_blocking=True)
                 outputs = self.model(x_batch)
                 loss = self.criterion(outputs, y_batch)
                 total_loss += loss.item() * len(x_batch)
@@ -823,7 +2543,7 @@ class Trainer:
 
     def train(self, train_dataset, validation_dataset=None,
               num_epochs=10, batch_size=8, shuffle=True,
-              save_steps=100, eval_steps=100, collate_fn=None):
+              save_steps=100, eval_steps=100, collate_fn=None, bucket_width=None, repeat_counts=False, dataloader_options=None):
         """ Handles the training loop for the model.
 
         Args:
@@ -835,17 +2555,28 @@ class Trainer:
             save_steps (int, optional): Number of steps post which a checkpoint should be saved. Defaults to 100.
             eval_steps (int, optional): Number of steps post which the model should be evaluated. Defaults to 100.
             collate_fn (function, optional): Function to use for collating instances to a batch.
+            bucket_width (int, optional): If given, batches instances of similar length together, see `make_dataloader`.
+                Defaults to None.
+            repeat_counts (bool, optional): If true, samples training instances as often as they occur in the source data,
+                see `make_dataloader`. Validation instances are still used once each. Defaults to False.
+            dataloader_options (dict, optional): Worker and memory options for `make_dataloader`. Defaults to None.
         """
 
         current_checkpoint = 0
         self.model.to(self.device)
         self.model.train()
 
-        with tqdm.tqdm(total = math.ceil(len(train_dataset) / batch_size) * num_epochs) as pbar:
+        # Dataloaders are built once: samplers reshuffle on every pass, and persistent workers are reused across epochs.
+        dataloader_options = dataloader_options or {}
+        train_dataloader = self.make_dataloader(train_dataset, shuffle, batch_size, collate_fn, bucket_width, repeat_counts, **dataloader_options)
+        if validation_dataset is not None:
+            validation_dataloader = self.make_dataloader(validation_dataset, False, batch_size, collate_fn, bucket_width, **dataloader_options)
+
+        # Bucketed batches are not all full, so count the batches rather than dividing the dataset size.
+        # Streamed datasets have no known length, in which case progress is shown without a total.
+        steps_per_epoch = None if isinstance(train_dataset, torch.utils.data.IterableDataset) else len(train_dataloader)
+        with tqdm.tqdm(total = steps_per_epoch and steps_per_epoch * num_epochs) as pbar:
             for epoch in range(num_epochs):
-                train_dataloader      = self.make_dataloader(train_dataset, shuffle, batch_size, collate_fn)
-                if validation_dataset is not None:
-                    validation_dataloader = self.make_dataloader(validation_dataset, shuffle, batch_size, collate_fn)
 
                 for batch, (x_batch, y_batch) in enumerate(train_dataloader):
                     pbar.set_description(f"Epoch {epoch+1} / {num_epochs}")
@@ -873,7 +2604,7 @@ class Trainer:
                             val_loss = None
 
                         print('[>]', f"epoch #{epoch+1:{len(str(num_epochs))}},",
-                              f"batch #{batch+1:{len(str(len(train_dataloader)))}}:",
+                              f"batch #{batch+1:{len(str(steps_per_epoch or ''))}}:",
                               "loss:", f"{loss:.8f}", '|', "val_loss:", f"{val_loss:.8f}")
 
                     # Save after every save_steps
@@ -1031,7 +2762,8 @@ class RNNEncoderDecoderLM(torch.nn.Module):
 
         Args:
             inputs (torch.Tensor): tensor of shape [batch_size?, max_seq_length]
-            decoder_inputs (torch.Tensor): tensor of shape [batch_size?, 1]
+            decoder_inputs (torch.Tensor): tensor of shape [batch_size?, 1] for a single step,
+                or [batch_size?, tgt_seq_len] for a whole teacher-forced sequence.
             decoder_hidden_state (any): tensor to represent decoder hidden state from time step T-1.
 
         Returns:
@@ -1089,6 +2821,54 @@ class RNNEncoderDecoderLM(torch.nn.Module):
             return log_probability.sum().item()
         # END CODE
 
+def _enlarge_rows(module, num_rows):
+    """ Returns a freshly initialized copy of an embedding or linear layer with more output rows,
+        where the existing rows (and biases) are carried over. """
+
+    if isinstance(module, nn.Embedding):
+        enlarged = nn.Embedding(num_rows, module.embedding_dim, padding_idx=module.padding_idx)
+    else:
+        enlarged = nn.Linear(module.in_features, num_rows, bias=module.bias is not None)
+    enlarged.to(device=module.weight.device, dtype=module.weight.dtype)
+
+    with torch.no_grad():
+        enlarged.weight[:module.weight.shape[0]].copy_(module.weight)
+        if getattr(module, 'bias', None) is not None:
+            enlarged.bias[:module.bias.shape[0]].copy_(module.bias)
+    return enlarged
+
+def enlarge_vocabulary(model, src_vocab_size=None, tgt_vocab_size=None):
+    """ Enlarges the vocabularies of a trained encoder-decoder model in place, to warm-start training
+        after its tokenizers were extended with `Tokenizer.extend`. Weights of existing token ids are kept,
+        rows for new ids are freshly initialized. An optimizer has to be created anew afterwards.
+
+    Args:
+        model (RNNEncoderDecoderLM|RNNEncoderDecoderLMWithAttention): Model to enlarge.
+        src_vocab_size (int, optional): New source vocabulary size. Defaults to None (unchanged).
+        tgt_vocab_size (int, optional): New target vocabulary size. Defaults to None (unchanged).
+
+    Raises:
+        ValueError: If a vocabulary size is smaller than the current one.
+
+    Returns:
+        torch.nn.Module: The same model, for convenience.
+    """
+
+    if src_vocab_size is not None:
+        if src_vocab_size < model.src_vocab_size:
+            raise ValueError(enlarge_vocabulary.__name__ + ": cannot shrink the source vocabulary")
+        model.encoder_embedding = _enlarge_rows(model.encoder_embedding, src_vocab_size)
+        model.src_vocab_size = src_vocab_size
+
+    if tgt_vocab_size is not None:
+        if tgt_vocab_size < model.tgt_vocab_size:
+            raise ValueError(enlarge_vocabulary.__name__ + ": cannot shrink the target vocabulary")
+        model.decoder_embedding = _enlarge_rows(model.decoder_embedding, tgt_vocab_size)
+        model.fc = _enlarge_rows(model.fc, tgt_vocab_size)
+        model.tgt_vocab_size = tgt_vocab_size
+
+    return model
+
 ## ==== END EVALUATION PORTION
 
 """To train the above model, implement for training and evaluation steps in the `RNNEncoderDecoderTrainer` class below:"""
@@ -1098,7 +2878,7 @@ class RNNEncoderDecoderLM(torch.nn.Module):
 class RNNEncoderDecoderTrainer(Trainer):
     """ Performs model training for RNN-based Encoder-Decoder models. """
 
-    def __init__(self, directory, model, criterion, optimizer):
+    def __init__(self, directory, model, criterion, optimizer, teacher_forcing='sequence', pad_token_id=0, end_token_id=4):
         """ Initializes the trainer.
 
         Args:
@@ -1106,12 +2886,28 @@ class RNNEncoderDecoderTrainer(Trainer):
             model (torch.nn.Module): Torch model to train.
             criterion (torch.nn.Function): Loss Criterion.
             optimizer (torch.optim.Optimizer): Optimizer to use.
+            teacher_forcing (str, optional): 'sequence' to feed the whole shifted target sequence to the model at once,
+                with a single loss over all positions not read from padding, or 'step' to feed it one token per call,
+                with a loss over all positions. Defaults to 'sequence'.
+            pad_token_id (int, optional): Id of the padding token in targets. In 'sequence' mode, the loss ignores
+                predictions made after reading a padding token. Defaults to 0.
+            end_token_id (int, optional): Id of the end-of-text token, which in 'sequence' mode is always
+                the target right after the text, whether or not the target is padded. Defaults to 4.
+
+        Raises:
+            ValueError: If the teacher forcing mode is unknown.
         """
 
         super(RNNEncoderDecoderTrainer, self).__init__(directory, model, criterion, optimizer)
+        if teacher_forcing not in ('sequence', 'step'):
+            raise ValueError(self.__init__.__qualname__ + f": unknown teacher forcing mode {teacher_forcing!r}")
+        self.teacher_forcing = teacher_forcing
+        self.pad_token_id    = pad_token_id
+        self.end_token_id    = end_token_id
 
     @staticmethod
-    def make_dataloader(dataset, shuffle_data=True, batch_size=8, collate_fn=None):
+    def make_dataloader(dataset, shuffle_data=True, batch_size=8, collate_fn=None, bucket_width=None, repeat_counts=False,
+                        num_workers=0, persistent_workers=True, prefetch_factor=2, pin_memory=False):
         """ Create a dataloader for a torch Dataset.
 
         Args:
@@ -1119,6 +2915,16 @@ class RNNEncoderDecoderTrainer(Trainer):
             shuffle_data (bool, optional): If true, shuffles the data. Defaults to True.
             batch_size (int, optional): Number of items per batch. Defaults to 8.
             collate_fn (function, optional): Function to collate instances in a batch.
+            bucket_width (int, optional): If given, batches instances of similar length with a `BucketBatchSampler`
+                of this bucket width. Requires the dataset to provide `token_lengths`. Defaults to None.
+            repeat_counts (bool, optional): If true, samples every instance as many times per epoch as it occurs
+                in the source data, restoring the frequencies of pairs merged by `prepare_dataframe`.
+                Requires the dataset to provide `instance_counts`. Defaults to False.
+            num_workers (int, optional): Number of worker processes to load batches in. Defaults to 0 (in this process).
+            persistent_workers (bool, optional): If true, keeps workers alive across epochs. Defaults to True.
+            prefetch_factor (int, optional): Number of batches loaded ahead by each worker. Defaults to 2.
+            pin_memory (bool, optional): If true and CUDA is available, loads batches into pinned memory,
+                for faster, asynchronous transfers to the GPU. Defaults to False.
 
         Returns:
             torch.utils.data.DataLoader: Dataloader over the given data, post processing.
@@ -1127,11 +2933,39 @@ class RNNEncoderDecoderTrainer(Trainer):
         # BEGIN CODE : rnn-enc-dec-trainer.make_dataloader
 
         # ADD YOUR CODE HERE
+        options = dict(
+            collate_fn=collate_fn,
+            num_workers=num_workers,
+            pin_memory=pin_memory and torch.cuda.is_available()
+            )
+        # Worker options are only accepted when batches are loaded in worker processes.
+        if num_workers > 0:
+            options.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+
+        counts = dataset.instance_counts() if repeat_counts else None
+
+        # Streamed datasets shuffle by themselves, within a bounded buffer.
+        if isinstance(dataset, torch.utils.data.IterableDataset):
+            return DataLoader(dataset=dataset, batch_size=batch_size, **options)
+        if bucket_width is not None:
+            return DataLoader(
+                dataset=dataset,
+                batch_sampler=BucketBatchSampler(dataset.token_lengths(), batch_size, bucket_width, shuffle_data, counts),
+                **options
+                )
+        if counts is not None:
+            indices = numpy.repeat(numpy.arange(len(dataset)), counts)
+            return DataLoader(
+                dataset=dataset,
+                sampler=torch.utils.data.SubsetRandomSampler(indices) if shuffle_data else indices.tolist(),
+                batch_size=batch_size,
+                **options
+                )
         return DataLoader(
             dataset=dataset,
             shuffle=shuffle_data,
             batch_size=batch_size,
-            collate_fn=collate_fn
+            **options
             )
         # END CODE
 
@@ -1153,17 +2987,20 @@ class RNNEncoderDecoderTrainer(Trainer):
         # ADD YOUR CODE HERE
         self.model.train()
         self.optimizer.zero_grad()
-        x_batch = x_batch.to(self.device)
-        y_batch = y_batch.to(self.device)
-        decoder_hidden_state = None
-        loss = 0 #fwd
-        for i in range(y_batch.shape[1] - 1):
-            decoder_input = y_batch[:, i:i + 1]
-            decoder_output_probs, decoder_hidden_state = self.model(x_batch, decoder_input, decoder_hidden_state)
-            target_next_token = y_batch[:, i + 1:i + 2]
-            step_loss = self.criterion(decoder_output_probs.squeeze(dim=1), target_next_token.squeeze(dim=1))
-            loss += step_loss
-        loss /= y_batch.shape[1]
+        x_batch = x_batch.to(self.device, non_blocking=True)
+        y_batch = y_batch.to(self.device, non_blocking=True)
+        if self.teacher_forcing == 'sequence':
+            loss, _ = self.sequence_loss(x_batch, y_batch)
+        else:
+            decoder_hidden_state = None
+            loss = 0 #fwd
+            for i in range(y_batch.shape[1] - 1):
+                decoder_input = y_batch[:, i:i + 1]
+                decoder_output_probs, decoder_hidden_state = self.model(x_batch, decoder_input, decoder_hidden_state)
+                target_next_token = y_batch[:, i + 1:i + 2]
+                step_loss = self.criterion(decoder_output_probs.squeeze(dim=1), target_next_token.squeeze(dim=1))
+                loss += step_loss
+            loss /= y_batch.shape[1]
         loss.backward() #bkw
         self.optimizer.step()
         return loss.item()
@@ -1186,9 +3023,20 @@ class RNNEncoderDecoderTrainer(Trainer):
         total_loss = 0.0
         totalbatch = 0
         with torch.no_grad():
+            if self.teacher_forcing == 'sequence':
+                # Averaged over all target positions of the validation data not read from padding.
+                total_tokens = 0
+                for x_batch, y_batch in validation_dataloader:
+                    x_batch = x_batch.to(self.device, non_blocking=True)
+                    y_batch = y_batch.to(self.device, non_blocking=True)
+                    loss, num_tokens = self.sequence_loss(x_batch, y_batch)
+                    total_loss   += loss.item() * num_tokens
+                    total_tokens += num_tokens
+                return total_loss / max(total_tokens, 1)
+
             for x_batch, y_batch in validation_dataloader:
-                x_batch = x_batch.to(self.device)
-                y_batch = y_batch.to(self.device)
+                x_batch = x_batch.to(self.device, non_blocking=True)
+                y_batch = y_batch.to(self.device, non_blocking=True)
                 decoder_hidden_state = None
                 ls = 0 #fwd
                 for i in range(y_batch.shape[1] - 1):
@@ -1203,6 +3051,26 @@ class RNNEncoderDecoderTrainer(Trainer):
         return valloss
         # END CODE
 
+    def sequence_loss(self, x_batch, y_batch):
+        """ Computes the teacher-forced loss over whole target sequences, with a single call to the model:
+            the decoder reads all target tokens but the last, and predicts all target tokens but the first.
+
+        Args:
+            x_batch (torch.Tensor): Input batch tensor, of shape [batch_size, src_len].
+            y_batch (torch.Tensor): Output batch tensor, of shape [batch_size, tgt_len].
+
+        Returns:
+            tuple[torch.Tensor, int]: Mean loss over the target positions not read from padding, and their number.
+        """
+
+        inputs, targets = y_batch[:, :-1], y_batch[:, 1:]
+        decoder_output_probs, _ = self.model(x_batch, inputs)
+        # Targets are padded in between the text and the end-of-text token (see `Tokenizer.pad`), so the position
+        # after the text is made to predict the end-of-text token in every row, and predictions made from padding are ignored.
+        mask    = inputs != self.pad_token_id
+        targets = torch.where(mask & (targets == self.pad_token_id), self.end_token_id, targets)
+        return self.criterion(decoder_output_probs[mask], targets[mask]), int(mask.sum())
+
 ## ==== END EVALUATION PORTION
 
 ## == BEGIN EVALUATION PORTION
@@ -1225,6 +3093,7 @@ rnn_enc_dec_params = {
 rnn_enc_dec_data_params = dict(
     src_padding=20,
     tgt_padding=20,
+    dynamic_padding=True,
 )
 
 # Add parameters related to training here.
@@ -1233,7 +3102,10 @@ rnn_enc_dec_training_params = dict(
     batch_size=512,
     shuffle=True,
     save_steps=100,
-    eval_steps=50
+    eval_steps=50,
+    bucket_width=1,
+    repeat_counts=True,
+    dataloader_options=dict(num_workers=2, persistent_workers=True, prefetch_factor=4, pin_memory=True)
 )
 
 # END CODE
@@ -1254,15 +3126,17 @@ criterion = nn.CrossEntropyLoss()
 
 trainer = RNNEncoderDecoderTrainer(
     os.path.join(DIRECTORY_NAME, "rnn.enc-dec"),
-    model, criterion, optimizer
+    model, criterion, optimizer,
+    teacher_forcing='sequence', pad_token_id=tgt_tokenizer.pad_token_id,
+    end_token_id=tgt_tokenizer.special_token_ids[tgt_tokenizer.EOT_token]
 )
 
 ## == END EVALUATION PORTION
 
 # Please do not change anything in the following cell.
 
-train_dataset      = TokenizerDataset(train_data     , src_tokenizer, tgt_tokenizer, **rnn_enc_dec_data_params)
-validation_dataset = TokenizerDataset(validation_data, src_tokenizer, tgt_tokenizer, **rnn_enc_dec_data_params)
+train_dataset      = CachedTokenizerDataset(train_data     , src_tokenizer, tgt_tokenizer, **rnn_enc_dec_data_params)
+validation_dataset = CachedTokenizerDataset(validation_data, src_tokenizer, tgt_tokenizer, **rnn_enc_dec_data_params)
 
 rnn_enc_dec_train_data = dict(
     train_dataset=train_dataset,
@@ -1292,6 +3166,25 @@ Extensive evaluation and comparison against other approaches will be carried out
 """
 
 import numpy as np
+
+def truncate_generation(tokens, end_token_id, pad_token_id):
+    """ Cuts a generated token sequence at its first end-of-text or padding token, whichever comes first,
+        so that it always ends in a single end-of-text token.
+
+    Args:
+        tokens (list[int]): Generated token ids, starting with the start-of-text token.
+        end_token_id (int): Id of the end-of-text token.
+        pad_token_id (int): Id of the padding token.
+
+    Returns:
+        list[int]: Token ids up to and including the end-of-text token.
+    """
+
+    for index, token in enumerate(tokens[1:], start=1):
+        if token == end_token_id or token == pad_token_id:
+            return tokens[:index] + [ end_token_id ]
+    return tokens + [ end_token_id ]
+
 def rnn_greedy_generate(model, seq_x, src_tokenizer, tgt_tokenizer, max_length):
     """ Given a source string, translate it to the target language using the trained model.
         This function should perform greedy sampling to generate the results.
@@ -1317,25 +3210,27 @@ def rnn_greedy_generate(model, seq_x, src_tokenizer, tgt_tokenizer, max_length):
     start = tgt_tokenizer.SOT_token
     pad = tgt_tokenizer.pad_token
     endt = tgt_tokenizer.EOT_token
-    special_tgt =tgt_tokenizer.get_special_tokens()
-    tgt_vocab = tgt_tokenizer.get_vocabulary()
-    padid = tgt_vocab[pad]
+    special_tgt =tgt_tokenizer.special_token_ids
+    padid = tgt_tokenizer.pad_token_id
     endid = special_tgt[endt]
     with torch.no_grad():
         final = []
         decoder_hidden_state = None
         decoder_input = torch.tensor([[special_tgt[start]]],device='cuda')
         final.append(decoder_input.item())
+        # Models that can encode the source once are decoded step by step from that encoding.
+        encoder_state = model.encode(beforetens) if hasattr(model, 'decode_step') else None
         for _ in range(max_length):
-            decoder_output, decoder_hidden_state = model(beforetens, decoder_input, decoder_hidden_state)
+            if encoder_state is not None:
+                decoder_output, decoder_hidden_state = model.decode_step(encoder_state, decoder_input, decoder_hidden_state)
+            else:
+                decoder_output, decoder_hidden_state = model(beforetens, decoder_input, decoder_hidden_state)
             output_probs = decoder_output
             predicted_token_index = torch.argmax(output_probs, dim=-1)
             final.append(predicted_token_index.item())
-            if predicted_token_index ==endid: break
+            if predicted_token_index ==endid or predicted_token_index ==padid: break
             decoder_input = torch.tensor([[predicted_token_index]],device='cuda')
-        idx = final.index(padid)
-        final = final[:idx+1]
-        final[-1] =4
+        final = truncate_generation(final, endid, padid)
         decoded_string = tgt_tokenizer.decode(final)
         # print("decoded:", decoded_string)
         # print("special tockens:", special_tgt)
@@ -1421,41 +3316,80 @@ Some popular approaches are desribed in the original [paper by Bahdanau et al.,
 class AttentionModule(torch.nn.Module):
     """ Implements an attention module """
 
+    SCORINGS = ('additive', 'dot', 'general')
+
     # Feel free to add additional parameters to __init__
-    def __init__(self, input_size):
+    def __init__(self, input_size, scoring='additive'):
         """ Initializes the attention module.
-            Feel free to declare any parameters as required. """
+            Feel free to declare any parameters as required.
+
+        Args:
+            input_size (int): Size of the encoder outputs and the decoder hidden state.
+            scoring (str, optional): Scoring function: 'additive' (Bahdanau, v . tanh(U h + W e)),
+                'dot' (Luong, h . e) or 'general' (Luong, h . W e). Defaults to 'additive'.
+
+        Raises:
+            ValueError: If the scoring function is unknown.
+        """
 
         super(AttentionModule, self).__init__()
 
         # BEGIN CODE : attn.init
         # ADD YOUR CODE HERE
-        self.W = nn.Linear(input_size,input_size)
-        self.V = nn.Linear(input_size,1)
-        self.U = nn.Linear(input_size,input_size)
+        if scoring not in self.SCORINGS:
+            raise ValueError(self.__init__.__qualname__ + f": unknown scoring function {scoring!r}")
+        self.scoring = scoring
+        if scoring != 'dot':
+            self.W = nn.Linear(input_size,input_size)
+        if scoring == 'additive':
+            self.V = nn.Linear(input_size,1)
+            self.U = nn.Linear(input_size,input_size)
         # END CODE
 
-    def forward(self, encoder_outputs, decoder_hidden_state):
+    def project_keys(self, encoder_outputs):
+        """ Projects encoder outputs to attention keys, which can be computed once per source sequence.
+
+        Args:
+            encoder_outputs (torch.Tensor): Output representations from the encoder, of shape [batch_size, src_seq_len, output_dim].
+
+        Returns:
+            torch.Tensor: Attention keys, of the same shape.
+        """
+
+        return encoder_outputs if self.scoring == 'dot' else self.W(encoder_outputs)
+
+    def forward(self, encoder_outputs, decoder_hidden_state, keys=None, mask=None):
         """ Performs a forward pass over the module, computing attention scores for inputs.
 
         Args:
-            encoder_outputs (torch.Tensor): Output representations from the encoder, of shape [batch_size?, src_seq_len, output_dim].
-            decoder_hidden_state (torch.Tensor): Hidden state from the decoder at current time step, of appropriate shape as per RNN unit (with optional batch dim).
+            encoder_outputs (torch.Tensor): Output representations from the encoder, of shape [batch_size, src_seq_len, output_dim].
+            decoder_hidden_state (torch.Tensor): Hidden state from the decoder at current time step, of shape
+                [num_layers, batch_size, output_dim]. The top layer is used as the query.
+            keys (torch.Tensor, optional): Keys precomputed with `project_keys`. Computed from the encoder outputs if None.
+            mask (torch.Tensor, optional): Boolean tensor of shape [batch_size, src_seq_len], false on positions
+                (such as padding) that must not be attended to. Defaults to None (all positions).
 
         Returns:
-            torch.Tensor: Attentions scores for given inputs, of shape [batch_size?, 1, src_seq_len]
+            torch.Tensor: Attentions scores for given inputs, of shape [batch_size, 1, src_seq_len]
         """
 
         # BEGIN CODE : attn.forward
 
         # ADD YOUR CODE HERE
-        decoder_hidden_state = decoder_hidden_state.permute(1,0,2)
-        maxl = encoder_outputs.shape[1]
-        decoder_hidden_state = decoder_hidden_state.repeat(1,maxl,1)
-        attnscr = self.V(torch.tanh(self.U(decoder_hidden_state)+self.W(encoder_outputs)))
-        attnscr = attnscr.permute(0,2,1)
-        attn = torch.nn.functional.softmax(attnscr, dim=1)
-        return attn
+        if keys is None:
+            keys = self.project_keys(encoder_outputs)
+        query = decoder_hidden_state[-1]
+
+        if self.scoring == 'additive':
+            # The query is broadcast over source positions, rather than repeated.
+            scores = self.V(torch.tanh(self.U(query).unsqueeze(1) + keys)).transpose(1, 2)
+        else:
+            scores = torch.bmm(query.unsqueeze(1), keys.transpose(1, 2))
+
+        if mask is not None:
+            # The lowest finite value, rather than -inf, keeps rows without any valid position free of NaNs.
+            scores = scores.masked_fill(~mask.unsqueeze(1), torch.finfo(scores.dtype).min)
+        return torch.softmax(scores, dim=-1)
         # END CODE
 
 ## ==== END EVALUATION PORTION
@@ -1466,7 +3400,8 @@ class RNNEncoderDecoderLMWithAttention(torch.nn.Module):
     """ Implements an Encoder-Decoder network, using RNN units, augmented with attention. """
 
     # Feel free to add additional parameters to __init__
-    def __init__(self,src_vocab_size, tgt_vocab_size, embd_dims, hidden_size, num_layers=1, dropout=0.1):
+    def __init__(self,src_vocab_size, tgt_vocab_size, embd_dims, hidden_size, num_layers=1, dropout=0.1,
+                 attention_scoring='additive', pad_token_id=0):
         """ Initializes the encoder-decoder network, implemented via RNNs.
 
         Args:
@@ -1474,6 +3409,8 @@ class RNNEncoderDecoderLMWithAttention(torch.nn.Module):
             tgt_vocab_size (int): Target vocabulary size.
             embd_dims (int): Embedding dimensions.
             hidden_size (int): Size/Dimensions for the hidden states.
+            attention_scoring (str, optional): Scoring function of the attention, see `AttentionModule`. Defaults to 'additive'.
+            pad_token_id (int, optional): Id of the source padding token, never attended to. Defaults to 0.
         """
 
         super(RNNEncoderDecoderLMWithAttention, self).__init__()
@@ -1495,7 +3432,8 @@ class RNNEncoderDecoderLMWithAttention(torch.nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.encoder_rnn = nn.GRU(input_size=embd_dims,hidden_size=hidden_size,num_layers=num_layers,batch_first=True)
         self.decoder_rnn = nn.GRU(input_size = hidden_size+embd_dims,hidden_size=hidden_size,num_layers=num_layers,batch_first=True)
-        self.attention = AttentionModule(hidden_size)
+        self.pad_token_id = pad_token_id
+        self.attention = AttentionModule(hidden_size, attention_scoring)
         self.fc = nn.Linear(hidden_size,tgt_vocab_size)
         # END CODE
 
@@ -1517,18 +3455,11 @@ class RNNEncoderDecoderLMWithAttention(torch.nn.Module):
         # BEGIN CODE : enc-dec-rnn-attn.probability
 
         # ADD YOUR CODE HERE
-        # src_emb = self.dropout(self.src_embedding(seq_x.unsqueeze(0)))
-        # tgt_emb = self.dropout(self.tgt_embedding(seq_y.unsqueeze(0)))
-        logprobab = 0.0 #fwd
-        encoder_outputs, encoder_hidden = self.encoder_rnn(self.src_embedding(seq_x.unsqueeze(0)))
-        decoder_input = torch.tensor([[0]])
-        decoder_hidden_state=None
-        for y in seq_y:
-            output, decoder_hidden = self.decoder_rnn(torch.cat([self.tgt_embedding(decoder_input), encoder_hidden], dim=1), decoder_hidden_state)
-            true_token_prob = output[0, y].log()
-            logprobab += true_token_prob
-            decoder_input = y.unsqueeze(0).unsqueeze(0)
-        return logprobab.item()
+        # Every token after the first (start) token is scored given the tokens before it, encoding the source once.
+        with torch.no_grad():
+            seq_x, seq_y = seq_x.unsqueeze(0).to(self.device), seq_y.unsqueeze(0).to(self.device)
+            out_probs, _ = self.forward(seq_x, seq_y[:, :-1])
+            return out_probs.gather(-1, seq_y[:, 1:, None]).sum().item()
         # END CODE
 
     def attentions(self, seq_x, terminate_token, max_length):
@@ -1536,7 +3467,7 @@ class RNNEncoderDecoderLMWithAttention(torch.nn.Module):
 
         Args:
             seq_x (torch.tensor): Tensor representing the source sequence, of shape [src_seq_len] (no batch dim)
-            terminate_token (int): Token to use as EOS, to stop generating outputs.
+            terminate_token (int): Token to use as EOS, to stop generating outputs. Padding stops generation as well.
             max_length (int): Maximum length to use to terminate the sampling.
 
         Returns:
@@ -1548,18 +3479,18 @@ class RNNEncoderDecoderLMWithAttention(torch.nn.Module):
         # BEGIN CODE : rnn-enc-dec-attn.attentions
 
         # ADD YOUR CODE HERE
-        seq_x = seq_x.unsqueeze(0)
+        seq_x = seq_x.unsqueeze(0).to(self.device)
         decoder_inputs = torch.tensor([[1]]).to(self.device)
         decoder_hidden_state = None
         all_attentions = []
         best_output_tokens = []
+        encoder_state = self.encode(seq_x)
         for _ in range(max_length):
-            output, decoder_hidden_state, attn_weights = self.forward(seq_x, decoder_inputs, decoder_hidden_state, output_attention=True)
+            output, decoder_hidden_state, attn_weights = self.decode_step(encoder_state, decoder_inputs, decoder_hidden_state, output_attention=True)
             all_attentions.append(attn_weights.squeeze(1))
-            print(output)
-            best_token = output.argmax(dim=1).item()
+            best_token = output.argmax(dim=-1).item()
             best_output_tokens.append(best_token)
-            if best_token == terminate_token: break
+            if best_token == terminate_token or best_token == self.pad_token_id: break
             decoder_inputs = torch.tensor([[best_token]]).to(self.device)
             # output = self.fc_out(decoder_output)
             # output_token = output.argmax(-1).item()
@@ -1574,12 +3505,16 @@ class RNNEncoderDecoderLMWithAttention(torch.nn.Module):
             Accepts inputs for the encoder, inputs for the decoder, and hidden state for
                 the decoder to continue generation after the given input.
 
+            The source is encoded once per call. To decode step by step without encoding the source again,
+                use `encode` followed by `decode_step`.
+
         Args:
             inputs (torch.Tensor): tensor of shape [batch_size?, src_seq_len]
-            decoder_inputs (torch.Tensor): Decoder inputs, as tensor of shape [batch_size?, 1]
+            decoder_inputs (torch.Tensor): Decoder inputs, as tensor of shape [batch_size?, 1], or [batch_size?, tgt_seq_len]
+                to decode several (teacher-forced) steps at once.
             decoder_hidden_state (any): tensor to represent decoder hidden state from time step T-1.
             output_attention (bool): If true, this function should also return the
-                associated attention weights for the time step, of shape [batch_size?, 1, src_seq_len].
+                associated attention weights for the time steps, of shape [batch_size?, tgt_seq_len, src_seq_len].
 
         Returns:
             tuple[torch.Tensor, any]: output from the decoder, and associated hidden state for the next step.
@@ -1594,23 +3529,69 @@ class RNNEncoderDecoderLMWithAttention(torch.nn.Module):
 
         # BEGIN CODE : enc-dec-rnn-attn.forward
         # ADD YOUR CODE HERE
-        batch_size = inputs.shape[0]
-        if decoder_hidden_state is None:
-            decoder_hidden_state = torch.zeros(1,batch_size,self.hidden_size).to(self.device)
+        encoder_state = self.encode(inputs)
+        step_probs, step_attns = [], []
+        for i in range(decoder_inputs.shape[1]):
+            out_probs, decoder_hidden_state, attn = self.decode_step(
+                encoder_state, decoder_inputs[:, i:i+1], decoder_hidden_state, output_attention=True
+            )
+            step_probs.append(out_probs)
+            step_attns.append(attn)
+        out_probs, attn = torch.cat(step_probs, dim=1), torch.cat(step_attns, dim=1)
+        if output_attention:
+          return (out_probs,decoder_hidden_state,attn)
+        else:  return (out_probs,decoder_hidden_state)
+        # END CODE
+
+    def encode(self, inputs):
+        """ Encodes source sequences once, for any number of decoding steps with `decode_step`.
+
+        Args:
+            inputs (torch.Tensor): tensor of shape [batch_size, src_seq_len]
+
+        Returns:
+            dict[str, torch.Tensor]: Encoder state, with the encoder outputs ('outputs', of shape
+                [batch_size, src_seq_len, hidden_size]), the attention keys precomputed from them ('keys'),
+                and the mask of non-padding source positions ('mask').
+        """
+
         src_embedding = self.dropout(self.encoder_embedding(inputs))
-        encoder_output,encoder_hidden = self.encoder_rnn(src_embedding)
-        attn = self.attention(encoder_output,decoder_hidden_state)
-        context = torch.bmm(attn,encoder_output)
+        encoder_outputs, _ = self.encoder_rnn(src_embedding)
+        return {
+            'outputs': encoder_outputs,
+            'keys'   : self.attention.project_keys(encoder_outputs),
+            'mask'   : inputs != self.pad_token_id,
+        }
+
+    def decode_step(self, encoder_state, decoder_inputs, decoder_hidden_state=None, output_attention=False):
+        """ Performs a single decoding step, attending over an encoded source.
+
+        Args:
+            encoder_state (dict[str, torch.Tensor]): Encoder state, as returned by `encode`.
+            decoder_inputs (torch.Tensor): Decoder inputs, as tensor of shape [batch_size, 1]
+            decoder_hidden_state (torch.Tensor, optional): Decoder hidden state from the previous step.
+                Starts from zeros if None. Defaults to None.
+            output_attention (bool, optional): If true, also returns the attention weights for the step,
+                of shape [batch_size, 1, src_seq_len]. Defaults to False.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: Log probabilities over the target vocabulary, of shape
+                [batch_size, 1, tgt_vocab_size], and the hidden state for the next step (and the attention weights).
+        """
+
+        encoder_outputs = encoder_state['outputs']
+        if decoder_hidden_state is None:
+            decoder_hidden_state = torch.zeros(self.num_layers, encoder_outputs.shape[0], self.hidden_size, device=encoder_outputs.device)
+
+        attn = self.attention(encoder_outputs, decoder_hidden_state, encoder_state['keys'], encoder_state.get('mask'))
+        context = torch.bmm(attn, encoder_outputs)
         tgt_embedding = self.dropout(self.decoder_embedding(decoder_inputs))
-        tgt_embedding = torch.cat((tgt_embedding,context),dim=2)
-        decoder_outputs, hidden_state = self.decoder_rnn(tgt_embedding,decoder_hidden_state)
-        outputs = self.fc(decoder_outputs)
-        out_probs = nn.functional.log_softmax(outputs,dim=-1)
+        tgt_embedding = torch.cat((tgt_embedding, context), dim=2)
+        decoder_outputs, hidden_state = self.decoder_rnn(tgt_embedding, decoder_hidden_state)
+        out_probs = nn.functional.log_softmax(self.fc(decoder_outputs), dim=-1)
         if output_attention:
-          print("attention wgt:", attn)
-          return (out_probs,hidden_state,attn)
-        else:  return (out_probs,hidden_state)
-        # END CODE
+            return out_probs, hidden_state, attn
+        return out_probs, hidden_state
 
 ## ==== END EVALUATION PORTION
 
@@ -1627,13 +3608,15 @@ rnn_enc_dec_attn_params = {
     'embd_dims'     : 256,
     'hidden_size'   : 512,
     'dropout'       : 0.1,
-    'num_layers'    : 1
+    'num_layers'    : 1,
+    'attention_scoring': 'additive'
 }
 
 # Add parameters related to the dataset processing here.
 rnn_enc_dec_attn_data_params = dict(
     src_padding=20,
     tgt_padding=20,
+    dynamic_padding=True,
 )
 
 # Add parameters related to training here.
@@ -1642,7 +3625,10 @@ rnn_enc_dec_attn_training_params = dict(
     batch_size=512,
     shuffle=True,
     save_steps=100,
-    eval_steps=50
+    eval_steps=50,
+    bucket_width=1,
+    repeat_counts=True,
+    dataloader_options=dict(num_workers=2, persistent_workers=True, prefetch_factor=4, pin_memory=True)
 )
 
 # END CODE
@@ -1663,14 +3649,16 @@ criterion = nn.CrossEntropyLoss()
 
 trainer = RNNEncoderDecoderTrainer(
     os.path.join(DIRECTORY_NAME, "rnn.enc-dec.attn"),
-    model, criterion, optimizer
+    model, criterion, optimizer,
+    teacher_forcing='sequence', pad_token_id=tgt_tokenizer.pad_token_id,
+    end_token_id=tgt_tokenizer.special_token_ids[tgt_tokenizer.EOT_token]
 )
 ## == END EVALUATION PORTION
 
 # Please do not change anything in the following cell.
 
-train_dataset      = TokenizerDataset(train_data     , src_tokenizer, tgt_tokenizer, **rnn_enc_dec_attn_data_params)
-validation_dataset = TokenizerDataset(validation_data, src_tokenizer, tgt_tokenizer, **rnn_enc_dec_attn_data_params)
+train_dataset      = CachedTokenizerDataset(train_data     , src_tokenizer, tgt_tokenizer, **rnn_enc_dec_attn_data_params)
+validation_dataset = CachedTokenizerDataset(validation_data, src_tokenizer, tgt_tokenizer, **rnn_enc_dec_attn_data_params)
 
 rnn_enc_dec_attn_train_data = dict(
     train_dataset=train_dataset,
@@ -2088,11 +4076,10 @@ def rnn_better_generate(model, seq_x, src_tokenizer, tgt_tokenizer, max_length,
     end = tgt_tokenizer.EOT_token
     start = tgt_tokenizer.SOT_token
     pad = tgt_tokenizer.pad_token
-    spctoks =tgt_tokenizer.get_special_tokens()
-    tgt_vocab = tgt_tokenizer.get_vocabulary()
+    spctoks =tgt_tokenizer.special_token_ids
     endid = spctoks[end]
     startid = spctoks[start]
-    padid = tgt_vocab[pad]
+    padid = tgt_tokenizer.pad_token_id
     with torch.no_grad():
         decoded_tokens = []
         decoder_hidden_state = None
@@ -2100,13 +4087,19 @@ def rnn_better_generate(model, seq_x, src_tokenizer, tgt_tokenizer, max_length,
         decoded_tokens.append(decoder_input.item())
         beam = [([startid], 0)]
         print(f"decoder input tensor: {decoder_input}")
+        # Models that can encode the source once are decoded step by step from that encoding.
+        encoder_state = model.encode(beforetens) if hasattr(model, 'decode_step') else None
         for _ in range(max_length):
             candidates = []
+            if all(prefix[-1] in (endid, padid) for prefix, _ in beam): break
             for prefix, score in beam:
-                if prefix[-1] == endid:
+                if prefix[-1] in (endid, padid):
                     candidates.append((prefix, score))
                     continue
-                outputs,decoder_hidden_state = model(beforetens,decoder_input,decoder_hidden_state)
+                if encoder_state is not None:
+                    outputs,decoder_hidden_state = model.decode_step(encoder_state,decoder_input,decoder_hidden_state)
+                else:
+                    outputs,decoder_hidden_state = model(beforetens,decoder_input,decoder_hidden_state)
                 ops = outputs.view(-1).cpu().detach().numpy()
                 top_indices = np.argsort(ops)[-k:]
                 for index in top_indices:
@@ -2117,9 +4110,7 @@ def rnn_better_generate(model, seq_x, src_tokenizer, tgt_tokenizer, max_length,
             temp= beam[0][0]
             decoder_input = torch.tensor([[temp[-1]]],device='cuda')
         bestseq, bestsrc = beam[0]
-        idx = bestseq.index(padid)
-        bestseq = bestseq[:idx+1]
-        bestseq[-1] =4
+        bestseq = truncate_generation([ int(token) for token in bestseq ], endid, padid)
         op = tgt_tokenizer.decode(bestseq)
         print("beam candidates:")
         for i, (prefix, score) in enumerate(beam):